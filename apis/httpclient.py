@@ -0,0 +1,243 @@
+"""
+Shared HTTP client for the apis/* modules.
+
+Every lookup goes through one requests.Session, so connections to the same
+backend are kept alive in a per-host pool and reused instead of paying a new
+TCP (and for moedict.tw, TLS) handshake per command.  urllib3 does not
+pipeline requests; concurrent lookups to one host get their own pooled
+connections instead.
+
+Identical GETs in flight at the same time are coalesced: the first one
+goes out, and the threads asking for the same URL meanwhile wait for it and
+share its response (with the body already read), so a burst of people
+asking for the same thing costs the backend one request.
+
+Code running under within() (see core.backends) has its requests cut off
+at a deadline, and the 5xx responses it gets are counted as failures.
+"""
+import socket
+import sys
+import threading
+import time
+from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core import metrics
+
+TIMEOUT = 10            # seconds, for connect and for each read
+POOL_CONNECTIONS = 10   # number of hosts to keep a pool for
+POOL_MAXSIZE = 10       # idle keep-alive connections kept per host
+
+_session = None
+_flights = {}           # request key -> Flight in progress
+_flightsLock = threading.Lock()
+_call = threading.local()   # deadline and 5xx count of within() on this thread
+
+COALESCED = metrics.counter('http_coalesced_total',
+                            'GETs answered by an identical one already in flight', ('host', ))
+# GETs with only these arguments can be shared; anything else goes out alone
+SHAREABLE = frozenset(['params', 'headers', 'timeout', 'allow_redirects'])
+
+
+
+class DeadlineExceeded(requests.Timeout):
+    """ A backend lookup ran out of time """
+
+
+
+class Flight(object):
+    """ A GET in progress, and the threads waiting for its response """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None       # exc_info of a failed request
+
+
+
+def configure(c):
+    """ Apply the [http] section of config.cfg and start a fresh session """
+    from core.config import option
+    global TIMEOUT, POOL_CONNECTIONS, POOL_MAXSIZE, _session
+    TIMEOUT = option(c, 'http', 'timeout', float(TIMEOUT))
+    POOL_CONNECTIONS = option(c, 'http', 'pool_connections', POOL_CONNECTIONS)
+    POOL_MAXSIZE = option(c, 'http', 'pool_maxsize', POOL_MAXSIZE)
+    _session = None
+
+
+def session():
+    """ The shared keep-alive session, created on first use """
+    global _session
+    if _session is None:
+        s = requests.Session()
+        for prefix in ('http://', 'https://'):
+            s.mount(prefix, HTTPAdapter(pool_connections=POOL_CONNECTIONS,
+                                        pool_maxsize=POOL_MAXSIZE))
+        _session = s
+    return _session
+
+
+def within(deadline, f, *args):
+    """
+    f(*args), with every request it makes cut off at time <deadline>;
+    returns (result, number of 5xx responses it got)
+    """
+    _call.deadline = deadline
+    _call.serverErrors = 0
+    try:
+        return f(*args), _call.serverErrors
+    finally:
+        _call.deadline = None
+
+
+def _limit(kwargs):
+    """ Shorten the timeout of a request to what is left before the deadline """
+    kwargs.setdefault('timeout', TIMEOUT)
+    deadline = getattr(_call, 'deadline', None)
+    if deadline is not None:
+        left = deadline - time.time()
+        if left <= 0:
+            raise DeadlineExceeded('deadline passed')
+        kwargs['timeout'] = min(kwargs['timeout'], left)
+
+
+def _checked(r):
+    if r.status_code >= 500 and getattr(_call, 'deadline', None) is not None:
+        _call.serverErrors += 1
+    return r
+
+
+def get(url, **kwargs):
+    _limit(kwargs)
+    key = flightKey(url, kwargs)
+    if key is None:
+        return _checked(session().get(url, **kwargs))
+    return _checked(coalesced(key, lambda: session().get(url, **kwargs)))
+
+
+def flightKey(url, kwargs):
+    """ What makes two GETs the same request, or None if they cannot share """
+    if not SHAREABLE.issuperset(kwargs):
+        return None
+    try:
+        params = kwargs.get('params') or {}
+        headers = kwargs.get('headers') or {}
+        return (url, tuple(sorted(dict(params).items())), tuple(sorted(headers.items())),
+                kwargs.get('allow_redirects', True))
+    except (TypeError, ValueError):
+        return None
+
+
+def coalesced(key, fetch):
+    """
+    fetch(), unless the same request is already in flight on another
+    thread, in which case wait for that one and return its response
+    """
+    with _flightsLock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+    if not leader:
+        COALESCED.inc(urlsplit(key[0]).hostname)
+        # the leader's own timeout bounds the wait
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error[0], flight.error[1], flight.error[2]
+        return flight.response
+    try:
+        r = fetch()
+        r.content       # read the body now, so every waiter can use it
+        flight.response = r
+        return r
+    except Exception:
+        flight.error = sys.exc_info()
+        raise
+    finally:
+        with _flightsLock:
+            del _flights[key]
+        flight.done.set()
+
+
+def post(url, data=None, **kwargs):
+    _limit(kwargs)
+    return _checked(session().post(url, data=data, **kwargs))
+
+
+def warm(url):
+    """
+    Open a keep-alive connection to the host of <url> ahead of time, with
+    a HEAD request so nothing but headers comes back.
+    """
+    session().head(url, timeout=TIMEOUT)
+
+
+def abandon(response):
+    """
+    Give up on the rest of a stream=True response.  Unread data would be
+    mistaken for the next response, so the connection is closed (and
+    reopened on next use) rather than handed back to the pool as is.
+    """
+    raw = response.raw
+    conn = getattr(raw, '_connection', None)
+    if conn is not None:
+        conn.close()
+    raw.release_conn()
+
+
+class Arriving(object):
+    """
+    The body of a stream=True response as a file whose read() returns what
+    has arrived so far rather than waiting for a full buffer, so a parser
+    fed from it (like etree.iterparse) sees each part as soon as it is in.
+    Only for responses sent without Content-Encoding.
+    """
+
+    def __init__(self, response):
+        self.raw = response.raw
+
+
+    def read(self, size):
+        return self.raw.read(self._available(size))
+
+
+    def _available(self, size):
+        """ How many of <size> bytes a read can return without waiting """
+        response = self.raw._fp     # the httplib response urllib3 reads from
+        try:
+            f = response.fp
+            f._rbuf.seek(0, 2)
+            n = f._rbuf.tell()      # read from the socket but not returned yet
+            if not n:
+                # blocks until something arrives, like a read would
+                n = max(len(f._sock.recv(size, socket.MSG_PEEK)), 1)
+        except (AttributeError, ValueError):
+            return size             # no plain socket underneath, e.g. TLS
+        if getattr(response, 'chunked', False):
+            # asking for more than the chunk holds would wait for the next
+            n = min(n, response.chunk_left or 1)
+        return min(n, size)
+
+
+
+def stats():
+    """
+    Connection reuse per host, as {host: {'hits': n, 'misses': n,
+    'coalesced': n}}.  A miss is a request that had to open a new
+    connection, a hit reused one; coalesced requests shared another's.
+    """
+    result = {}
+    if _session is None:
+        return result
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            result[pool.host] = {
+                'hits': max(pool.num_requests - pool.num_connections, 0),
+                'misses': pool.num_connections,
+                'coalesced': COALESCED.get(pool.host),
+            }
+    return result
@@ -1,4 +1,5 @@
-import requests
+import httpclient
+import procpool
 from bs4 import BeautifulSoup
 
 def getCurrentSong(username):
@@ -7,10 +8,16 @@ def getCurrentSong(username):
     @param: username (string)
     @returns: song (string)
     """
-    r = requests.get('http://ws.audioscrobbler.com/1.0/user/%s/recenttracks.rss' % username)
+    r = httpclient.get('http://ws.audioscrobbler.com/1.0/user/%s/recenttracks.rss' % username)
     if r.status_code == 200:
-        soup = BeautifulSoup(r.text)
-        return soup.item.title.string
+        return procpool.run(parseCurrentSong, r.text)
+
+
+def parseCurrentSong(rss):
+    """ The title of the latest track in a recenttracks.rss feed """
+    soup = BeautifulSoup(rss)
+    # a plain unicode, since NavigableStrings do not pickle
+    return unicode(soup.item.title.string)
 
 
 if __name__ == '__main__':
@@ -1,18 +1,20 @@
 # -*- coding: utf8 -*-
-import requests
+import httpclient
 import json
 
+FAILED = 'Cannot look up moedict.  Please try again in a few minutes.'
+
 def quote(word):
     from random import randint
     import urllib
     if word[0] == "'":  # 台語
-        r = requests.get('https://www.moedict.tw/uni/\'' + word[1:])
+        r = httpclient.get('https://www.moedict.tw/uni/\'' + word[1:])
     else:
-        r = requests.get('https://www.moedict.tw/uni/' + word)
+        r = httpclient.get('https://www.moedict.tw/uni/' + word)
     try:
         data = json.loads(r.text)
     except ValueError:
-        return 'Cannot look up moedict.  Please try again in a few minutes.'
+        return FAILED
 
     quotes = []
     try:
@@ -0,0 +1,98 @@
+"""
+Optional process pool for the CPU-heavy parse steps of the apis/* modules.
+
+Building a BeautifulSoup tree or an ElementTree of a large document holds
+the GIL for the whole parse, so even on a worker thread it stalls the
+reactor.  With [procpool] enabled, run(parse, text) sends the parse to a
+multiprocessing.Pool instead and waits for the result on the calling
+(worker) thread.  At most `max_pending` parses are queued or running at
+once; a parse that takes longer than `timeout` seconds raises Timeout, and
+workers are replaced after `maxtasksperchild` parses so leaks in lxml or bs4
+do not grow forever.  A parse that hangs would keep its worker busy for
+good, so a timeout replaces the whole pool; parses still running in the old
+one time out in turn.  Parse functions must be module-level so they can be
+pickled.
+
+Disabled (the default), run() simply calls the function in place.
+"""
+import multiprocessing
+import threading
+
+ENABLED = False
+PROCESSES = None        # default: one per CPU
+MAXTASKSPERCHILD = 100
+MAX_PENDING = 32
+TIMEOUT = 10.0          # seconds
+
+_pool = None
+_slots = None
+_lock = threading.Lock()
+
+
+class Busy(Exception):
+    """ More than MAX_PENDING parses are already waiting """
+
+
+class Timeout(Exception):
+    """ A parse took longer than TIMEOUT seconds """
+
+
+def configure(c):
+    """
+    Apply the [procpool] section of config.cfg.  Call before the reactor
+    starts any threads, since the workers are forked here.
+    """
+    from core.config import option
+    global ENABLED, PROCESSES, MAXTASKSPERCHILD, MAX_PENDING, TIMEOUT
+    ENABLED = option(c, 'procpool', 'enabled', ENABLED)
+    PROCESSES = option(c, 'procpool', 'processes', 0) or None
+    MAXTASKSPERCHILD = option(c, 'procpool', 'maxtasksperchild', MAXTASKSPERCHILD)
+    MAX_PENDING = option(c, 'procpool', 'max_pending', MAX_PENDING)
+    TIMEOUT = option(c, 'procpool', 'timeout', TIMEOUT)
+    shutdown()
+    if ENABLED:
+        start()
+
+
+def start():
+    global _pool, _slots
+    if _pool is None:
+        _slots = threading.BoundedSemaphore(MAX_PENDING)
+        _pool = multiprocessing.Pool(PROCESSES, maxtasksperchild=MAXTASKSPERCHILD)
+
+
+def _replace(pool):
+    """ Swap <pool>, with a worker stuck in a parse, for a fresh one """
+    global _pool
+    with _lock:
+        if _pool is not pool:
+            return      # replaced already, or shut down
+        _pool = multiprocessing.Pool(PROCESSES, maxtasksperchild=MAXTASKSPERCHILD)
+    pool.terminate()
+    pool.join()
+
+
+def shutdown():
+    """ Stop the workers, abandoning any parse still running """
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+def run(f, *args):
+    """ f(*args), in a worker process if the pool is enabled """
+    pool = _pool
+    if pool is None:
+        return f(*args)
+    if not _slots.acquire(False):
+        raise Busy('%d parses pending' % (MAX_PENDING, ))
+    try:
+        return pool.apply_async(f, args).get(TIMEOUT)
+    except multiprocessing.TimeoutError:
+        _replace(pool)
+        raise Timeout('%s took over %gs' % (f.__name__, TIMEOUT))
+    finally:
+        _slots.release()
@@ -1,4 +1,4 @@
-import requests
+import httpclient
 import json
 
 def getSubReddit(query, count):
@@ -8,7 +8,7 @@ def getSubReddit(query, count):
     """
 
     # send the request and get the data
-    r = requests.get('http://www.reddit.com/r/%s.json?limit=%s' % (query, count))
+    r = httpclient.get('http://www.reddit.com/r/%s.json?limit=%s' % (query, count))
 
     try:
         data = json.loads(r.text)
@@ -28,24 +28,38 @@ def getSubReddit(query, count):
     return response
 
        
-def getQuote():    
+def getQuotes(after=None, limit=100):
     """
-    Gets a random quote from the quotes subreddit
-    @return response dictionary 
+    Gets one page of titles from the quotes subreddit
+    @param after: listing cursor returned by the previous page, None for the top
+    @return (list of titles, cursor of the next page or None at the end)
     """
-    from random import randint
-
-    # send the request and get the data
-    r = requests.get('http://www.reddit.com/r/quotes.json?limit=100')
+    url = 'http://www.reddit.com/r/quotes.json?limit=%d' % (limit, )
+    if after:
+        url += '&after=%s' % (after, )
+    r = httpclient.get(url)
 
     try:
         data = json.loads(r.text)
     except ValueError:
-        return None
+        return [], None
 
-    if 'data' in data:
-        i = randint(0,len(data['data']['children'])-1)
-        response = data['data']['children'][i]['data']['title']
+    if 'data' not in data:
+        return [], None
+    titles = [c['data']['title'] for c in data['data']['children']]
+    return titles, data['data'].get('after')
+
+
+def getQuote():    
+    """
+    Gets a random quote from the quotes subreddit
+    @return response dictionary 
+    """
+    from random import randint
+
+    titles, after = getQuotes()
+    if titles:
+        response = titles[randint(0, len(titles)-1)]
     else:
         response = None
 
@@ -4,11 +4,11 @@ def rottentomatoes(query, apikey):
     @params movie name <string> api key <string>
     @return response dictionary 
     """
-    import requests
+    import httpclient
     import json
 
     # send the request and get the data
-    r = requests.get('http://api.rottentomatoes.com/api/public/v1.0/movies.json?apikey=%s&q=%s&page_limits=1' % (apikey, query))
+    r = httpclient.get('http://api.rottentomatoes.com/api/public/v1.0/movies.json?apikey=%s&q=%s&page_limits=1' % (apikey, query))
     data = json.loads(r.text)
 
     
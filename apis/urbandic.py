@@ -3,11 +3,11 @@ def urbanDict(query):
     Searches urbandictionary.com for a definition to the query given
     @return response dictionary 
     """
-    import requests
+    import httpclient
     import json
 
     # send the request and get the data
-    r = requests.get('http://api.urbandictionary.com/v0/define?term=%s' % (query))
+    r = httpclient.get('http://api.urbandictionary.com/v0/define?term=%s' % (query))
     data = json.loads(r.text)
 
     if data['list']:
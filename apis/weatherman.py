@@ -5,7 +5,7 @@ def currentWeather(city='Provo', state='UT', zip = None):
     @param state: String, 2 letter state abbreviation (UT)
     @return weather: Dict with status, temp rain (mm), and cloud %
     """
-    import requests
+    import httpclient
     import json
 
     # send the request and get the data
@@ -13,7 +13,7 @@ def currentWeather(city='Provo', state='UT', zip = None):
         qstring = '%s,%s' % (city, state)
     else:
         qstring = '%s,USA' % (zip)
-    r = requests.get('http://api.openweathermap.org/data/2.5/weather?q=%s' % (qstring))
+    r = httpclient.get('http://api.openweathermap.org/data/2.5/weather?q=%s' % (qstring))
 
     data = json.loads(r.text)
     weather = {
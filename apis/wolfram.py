@@ -1,42 +1,87 @@
 import sys
-import urllib2
-import urllib
-import httplib
+import httpclient
+import procpool
 from xml.etree import ElementTree as etree
+
+# pods that answer a question, best first
+PREFERRED = ('Value', 'Result', 'Definition', 'Statement', 'Current result')
  
+
+def parsePods(xml):
+    """ {pod title: plaintext} of a Wolfram|Alpha queryresult document """
+    data_dics = {}
+    tree = etree.fromstring(xml)
+    #retrieving every tag with label 'plaintext'
+    for e in tree.findall('pod'):
+        for item in [ef for ef in list(e) if ef.tag=='subpod']:
+            for it in [i for i in list(item) if i.tag=='plaintext']:
+                if it.tag=='plaintext':
+                    data_dics[e.get('title')] = it.text
+    return data_dics
+ 
+
 class wolfram(object):
+    """
+    Wolfram|Alpha client; one is shared by all questions, and all of them go
+    through the shared keep-alive session of apis.httpclient.
+    """
     def __init__(self, appid):
         self.appid = appid
         self.base_url = 'http://api.wolframalpha.com/v2/query?'
         self.headers = {'User-Agent':None}
  
     def _get_xml(self, question):
-        url_params = {'input':question, 'appid':self.appid}
-        data = urllib.urlencode(url_params)
-        #print data
-        req = urllib2.Request(self.base_url, data, self.headers)
-        #print req
-        xml = urllib2.urlopen(req).read()
+        url_params = {'input':question, 'appid':self.appid, 'format':'plaintext'}
+        xml = httpclient.post(self.base_url, url_params, headers=self.headers).content
         return xml
  
     def _xmlparser(self, xml):
-        data_dics = {}
-        tree = etree.fromstring(xml)
-        #retrieving every tag with label 'plaintext'
-        for e in tree.findall('pod'):
-            for item in [ef for ef in list(e) if ef.tag=='subpod']:
-                for it in [i for i in list(item) if i.tag=='plaintext']:
-                    if it.tag=='plaintext':
-                        data_dics[e.get('title')] = it.text
-        return data_dics
+        # module-level so the process pool can pickle it
+        return procpool.run(parsePods, xml)
  
     def search(self, question):
+        """ {pod title: plaintext} of every pod answering <question> """
         xml = self._get_xml(question)
         response = self._xmlparser(xml)
         return response
+
+    def answer(self, question):
+        """
+        The plaintext of the best PREFERRED pod answering <question>, or
+        None.  Only those pods are asked for, and the response is parsed as
+        it arrives: reading stops as soon as the best possible pod is in.
+        """
+        url_params = {'input':question, 'appid':self.appid, 'format':'plaintext',
+                      'podtitle':list(PREFERRED)}
+        headers = dict(self.headers)
+        # iterparse reads the socket as the data arrives, so no gzip
+        headers['Accept-Encoding'] = 'identity'
+        r = httpclient.post(self.base_url, url_params, headers=headers, stream=True)
+        best, rank = None, len(PREFERRED)
+        title = None
+        try:
+            for event, e in etree.iterparse(httpclient.Arriving(r), events=('start', 'end')):
+                if event == 'start':
+                    if e.tag == 'pod':
+                        title = e.get('title')
+                elif e.tag == 'plaintext':
+                    if title in PREFERRED[:rank] and e.text:
+                        best, rank = e.text, PREFERRED.index(title)
+                        if rank == 0:
+                            httpclient.abandon(r)
+                            return best
+                elif e.tag == 'pod':
+                    e.clear()
+        except etree.ParseError:
+            httpclient.abandon(r)
+            return best
+        r.raw.read()    # anything after the document, so the connection is reusable
+        r.close()
+        return best
  
 if __name__ == "__main__":
     appid = sys.argv[1]
     query = sys.argv[2]
     w = wolfram(appid)
+    print w.answer(query)
     print w.search(query)
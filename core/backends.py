@@ -0,0 +1,182 @@
+"""
+Deadlines, retries and circuit breakers for the API backends.
+
+Every lookup a command makes, through the response cache or LogBot.defer,
+and the background ones filling the quote pool and the cafe menu, goes
+through the Backend of its name ('moe', 'reddit', 'cafe', ...):
+
+  - the whole lookup, retries included, has a deadline.  The requests the
+    apis.* code makes are cut off at it (apis.httpclient.within), and the
+    command gets DeadlineExceeded rather than waiting any longer;
+  - connection errors and timeouts are retried up to `retries` times while
+    the deadline allows, after a random delay of up to backoff * 2**n
+    seconds, so the retries of a burst do not arrive together;
+  - after `failures` failed lookups in a row (exceptions or 5xx responses)
+    the breaker opens, and lookups fail at once with BackendDown for
+    `reset` seconds.  Then a single lookup is let through; it closes the
+    breaker if it succeeds and opens it again if not.
+
+The response cache answers BackendDown with whatever it still holds for
+the key, however old; commands with nothing cached get a canned reply.
+
+Settings come from [backends], with per-backend overrides named like
+deadline_wolfram.
+"""
+import random
+import weakref
+
+import requests
+from twisted.internet import defer, reactor, threads
+
+from apis import httpclient
+from apis.httpclient import DeadlineExceeded
+from core import metrics
+
+
+CLOSED = 'closed'
+HALF_OPEN = 'half-open'
+OPEN = 'open'
+STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BACKENDS = weakref.WeakSet()    # every Backend, for the gauge
+
+BACKEND_SECONDS = metrics.histogram('backend_seconds',
+                                    'Time taken by lookups in API backends', ('backend', ))
+BACKEND_ERRORS = metrics.counter('backend_errors_total',
+                                 'Backend lookups that failed', ('backend', ))
+RETRIES = metrics.counter('backend_retries_total', 'Backend lookups retried', ('backend', ))
+REJECTED = metrics.counter('backend_rejected_total',
+                           'Backend lookups refused by an open circuit breaker', ('backend', ))
+metrics.gauge('backend_breaker_state', 'Circuit breaker state: 0 closed, 1 half-open, 2 open',
+              lambda: dict(((b.name, ), STATES[b.state]) for b in list(BACKENDS)),
+              ('backend', ))
+
+
+class BackendDown(Exception):
+    """ The backend's circuit breaker is open """
+
+
+
+class Backend(object):
+
+    def __init__(self, name, deadline=10.0, retries=2, backoff=0.5, failures=5,
+                 reset=30.0, clock=reactor):
+        self.name = name
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.failures = failures
+        self.reset = reset
+        self.clock = clock
+        self.failed = 0         # failed lookups in a row
+        self.opened = None      # when the breaker last opened; None when closed
+        self.probing = False    # a half-open trial lookup is in flight
+        BACKENDS.add(self)
+
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return CLOSED
+        if self.probing or self.clock.seconds() >= self.opened + self.reset:
+            return HALF_OPEN
+        return OPEN
+
+
+    def call(self, f, *args):
+        """ A Deferred firing with f(*args), run on the thread pool """
+        state = self.state
+        if state == OPEN or (state == HALF_OPEN and self.probing):
+            REJECTED.inc(self.name)
+            return defer.fail(BackendDown(self.name))
+        self.probing = state == HALF_OPEN
+        d = defer.Deferred()
+        deadline = self.clock.seconds() + self.deadline
+        timer = self.clock.callLater(self.deadline, self._expired, d)
+        self._attempt(d, timer, deadline, 0, f, args)
+        return metrics.timeDeferred(d, BACKEND_SECONDS, BACKEND_ERRORS, self.name)
+
+
+    def _attempt(self, d, timer, deadline, attempt, f, args):
+        if d.called:
+            return
+
+        def done((result, serverErrors)):
+            if d.called:
+                return
+            timer.cancel()
+            self._record(not serverErrors)
+            d.callback(result)
+
+        def failed(failure):
+            if d.called:
+                return
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if (attempt < self.retries and failure.check(requests.RequestException) and
+                    not failure.check(DeadlineExceeded) and
+                    self.clock.seconds() + delay < deadline):
+                RETRIES.inc(self.name)
+                self.clock.callLater(delay, self._attempt, d, timer, deadline,
+                                     attempt + 1, f, args)
+                return
+            timer.cancel()
+            self._record(False)
+            d.errback(failure)
+
+        t = threads.deferToThread(httpclient.within, deadline, f, *args)
+        t.addCallbacks(done, failed)
+
+
+    def _expired(self, d):
+        if not d.called:
+            self._record(False)
+            d.errback(DeadlineExceeded('%s took more than %gs' % (self.name, self.deadline)))
+
+
+    def _record(self, ok):
+        self.probing = False
+        if ok:
+            self.failed = 0
+            self.opened = None
+            return
+        self.failed += 1
+        if self.opened is not None or self.failed >= self.failures:
+            self.opened = self.clock.seconds()
+
+
+
+class Backends(object):
+    """ The Backend of every name, made on first use from [backends] """
+
+    def __init__(self, c=None, clock=reactor):
+        self.config = c
+        self.clock = clock
+        self.backends = {}
+
+
+    def __getitem__(self, name):
+        backend = self.backends.get(name)
+        if backend is None:
+            backend = self.backends[name] = Backend(name,
+                    deadline=self._option('deadline', name, 10.0),
+                    retries=self._option('retries', name, 2),
+                    backoff=self._option('backoff', name, 0.5),
+                    failures=self._option('failures', name, 5),
+                    reset=self._option('reset', name, 30.0),
+                    clock=self.clock)
+        return backend
+
+
+    def _option(self, setting, name, default):
+        from core.config import option
+        default = option(self.config, 'backends', setting, default)
+        return option(self.config, 'backends', '%s_%s' % (setting, name), default)
+
+
+    def __iter__(self):
+        return iter(sorted(self.backends.values(), key=lambda b: b.name))
+
+
+    def call(self, name, f, *args):
+        """ f(*args) through the Backend called <name> """
+        return self[name].call(f, *args)
@@ -0,0 +1,180 @@
+"""
+Bounded in-memory cache for lookup commands.
+
+Results are keyed by the normalized (backend, args) of a command and kept
+for a per-backend TTL.  Once an entry expires it is still served for up to
+max_stale seconds while a single background refresh replaces it, so a hot
+key never waits on the network.  The cache is evicted in LRU order when it
+holds more than max_entries entries or max_bytes bytes.  While a backend
+is down (core.backends.BackendDown) the cache serves what it has for the
+key, however old.
+
+All methods are meant to be called on the reactor thread; only the fetch
+itself runs in the thread pool.
+"""
+import sys
+import time
+from collections import OrderedDict
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from core import metrics
+from core.backends import BackendDown, BACKEND_SECONDS, BACKEND_ERRORS
+
+
+def normalize(args):
+    """ Case- and whitespace-insensitive form of command arguments """
+    key = []
+    for a in args:
+        if isinstance(a, basestring):
+            a = ' '.join(a.split()).lower()
+        key.append(a)
+    return tuple(key)
+
+
+def direct(backend, f, *args):
+    """ Fetch by calling f(*args) on the thread pool """
+    d = threads.deferToThread(f, *args)
+    return metrics.timeDeferred(d, BACKEND_SECONDS, BACKEND_ERRORS, backend)
+
+
+def sizeof(value):
+    """ Rough size in bytes of a cached value """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.iteritems():
+            size += sizeof(k) + sizeof(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            size += sizeof(v)
+    return size
+
+
+class Entry(object):
+    __slots__ = ('value', 'size', 'expires')
+
+    def __init__(self, value, size, expires):
+        self.value = value
+        self.size = size
+        self.expires = expires
+
+
+class ResponseCache(object):
+
+    def __init__(self, max_entries=1000, max_bytes=4 * 1024 * 1024,
+                 ttl=300, ttls=None, max_stale=3600, clock=time.time, fetch=direct):
+        """
+        @param fetch: fetch(backend, f, *args), a Deferred firing with f(*args)
+        """
+        self.fetch = fetch
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.max_stale = max_stale
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.pending = {}       # key -> Deferreds waiting on a fetch
+        self.hits = self.misses = self.stale = self.evictions = self.fallbacks = 0
+
+
+    @classmethod
+    def fromConfig(cls, c, fetch=direct):
+        """ Build a cache from the [cache] section of config.cfg """
+        from core.config import option
+        ttls = {}
+        if c is not None and c.has_section('cache'):
+            for name, value in c.items('cache'):
+                if name.startswith('ttl_'):
+                    ttls[name[len('ttl_'):]] = float(value)
+        return cls(max_entries=option(c, 'cache', 'max_entries', 1000),
+                   max_bytes=option(c, 'cache', 'max_bytes', 4 * 1024 * 1024),
+                   ttl=option(c, 'cache', 'ttl', 300.0),
+                   ttls=ttls,
+                   max_stale=option(c, 'cache', 'max_stale', 3600.0),
+                   fetch=fetch)
+
+
+    def lookup(self, backend, f, *args, **kwargs):
+        """
+        Return a Deferred firing with f(*args), answered from the cache when
+        possible.  Results for which cacheable(result) is false (by default:
+        None) are passed on but not stored.
+        """
+        cacheable = kwargs.get('cacheable', lambda v: v is not None)
+        key = (backend,) + normalize(args)
+        now = self.clock()
+        entry = self.entries.get(key)
+        if entry is not None and now < entry.expires + self.max_stale:
+            self.entries[key] = self.entries.pop(key)   # most recently used
+            if now < entry.expires:
+                self.hits += 1
+            else:
+                self.stale += 1
+                if key not in self.pending:
+                    self._fetch(key, backend, cacheable, f, args).addErrback(log.err)
+            return defer.succeed(entry.value)
+
+        self.misses += 1
+        return self._fetch(key, backend, cacheable, f, args)
+
+
+    def _fetch(self, key, backend, cacheable, f, args):
+        d = defer.Deferred()
+        if key in self.pending:
+            self.pending[key].append(d)
+            return d
+        self.pending[key] = [d]
+
+        def done(result):
+            if cacheable(result):
+                self.put(key, backend, result)
+            for waiter in self.pending.pop(key):
+                waiter.callback(result)
+
+        def failed(failure):
+            entry = self.entries.get(key)
+            if failure.check(BackendDown) and entry is not None:
+                # an old answer beats none
+                self.fallbacks += 1
+                for waiter in self.pending.pop(key):
+                    waiter.callback(entry.value)
+                return
+            for waiter in self.pending.pop(key):
+                waiter.errback(failure)
+
+        self.fetch(backend, f, *args).addCallbacks(done, failed)
+        return d
+
+
+    def put(self, key, backend, value):
+        self.discard(key)
+        size = sizeof(value)
+        ttl = self.ttls.get(backend, self.ttl)
+        self.entries[key] = Entry(value, size, self.clock() + ttl)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or
+                                self.bytes > self.max_bytes):
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= old.size
+            self.evictions += 1
+
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'evictions': self.evictions,
+            'fallbacks': self.fallbacks,
+        }
@@ -0,0 +1,108 @@
+# -*- coding: utf8 -*-
+"""
+Registry of the commands the bot answers when addressed ("AL: moe 萌").
+
+Handlers are LogBot methods marked with the @command decorator:
+
+    @command('hi', u'哈囉', 'merhaba')
+    def hi(self, user, channel, args): ...
+
+The registry maps every name and alias to its handler in one dict, so
+dispatch is a single lookup; the help text is built once when the registry
+is created.  Whether a command is enabled comes from the [commands] section
+of config.cfg, e.g. `cafe = on`, falling back to the decorator's default.
+A channel section can override [commands] for one channel.
+"""
+
+
+def marked(cls, attr):
+    """
+    The <attr> markers left by decorators on the methods of class <cls> and
+    its bases, in the order the methods are defined.
+    """
+    from inspect import getmro
+    found = []
+    seen = set()
+    for klass in getmro(cls):
+        for name, value in vars(klass).items():
+            if name in seen:
+                continue
+            seen.add(name)
+            if hasattr(value, attr):
+                found.append(value)
+    found.sort(key=lambda f: f.func_code.co_firstlineno)
+    return [getattr(f, attr) for f in found]
+
+
+def command(*names, **options):
+    """
+    Mark a method as the handler for the direct command <names>.
+
+    @param help: line shown by `help`; commands without one are not listed
+    @param nargs: minimum number of arguments; fewer gets the usage line
+    @param admin: only answer owners configured in [admin]
+    @param enabled: default when config.cfg does not mention the command
+    @param warm: (module, url) to import and connect to in the background
+                 after signing on, so the first use does not wait on either
+    """
+    def decorate(f):
+        f.command = Command(names, f, **options)
+        return f
+    return decorate
+
+
+
+class Command(object):
+
+    def __init__(self, names, handler, help=None, nargs=0, admin=False,
+                 enabled=True, warm=None):
+        self.names = [n.lower() for n in names]
+        self.name = self.names[0]
+        self.handler = handler
+        self.help = help
+        self.nargs = nargs
+        self.admin = admin
+        self.enabled = enabled
+        self.warm = warm
+
+
+    @property
+    def usage(self):
+        return self.help or self.name
+
+
+
+class CommandRegistry(object):
+
+    def __init__(self, cls, c=None, override=None):
+        """
+        Collect the @command handlers of class <cls>, enabled according to
+        config section <override>, then [commands].
+        """
+        from core.config import option
+        self.commands = {}
+        self.enabled = []
+        for cmd in marked(cls, 'command'):
+            enabled = option(c, 'commands', cmd.name, cmd.enabled)
+            if override is not None:
+                enabled = option(c, override, cmd.name, enabled)
+            self.add(cmd, enabled)
+
+        lines = ['請使用以下指令:']
+        lines += [cmd.help for cmd in self.enabled
+                  if cmd.help is not None and not cmd.admin]
+        lines.append('或是隨便打，我不一定會去問 Wolfram')
+        self.help = '\n'.join(lines)
+
+
+    def add(self, cmd, enabled=True):
+        if not enabled:
+            return
+        self.enabled.append(cmd)
+        for n in cmd.names:
+            self.commands[n] = cmd
+
+
+    def get(self, name):
+        """ The enabled Command called <name>, or None """
+        return self.commands.get(name.lower())
@@ -0,0 +1,14 @@
+def option(c, section, name, default=None):
+    """
+    Read an optional setting from config.cfg.  The value is converted to the
+    type of <default>, which is also returned when the setting is missing.
+    """
+    if c is None or not c.has_option(section, name):
+        return default
+    if isinstance(default, bool):
+        return c.getboolean(section, name)
+    if isinstance(default, int):
+        return c.getint(section, name)
+    if isinstance(default, float):
+        return c.getfloat(section, name)
+    return c.get(section, name)
@@ -0,0 +1,324 @@
+"""
+Searchable channel history.
+
+Channel lines are appended to one segment file per day under the history
+directory, as `timestamp network+channel nick message` tab separated lines,
+the network and channel separated by a space (which channel names cannot
+contain; lines from before networks were recorded have the channel only).
+Every
+segment has an inverted index from word to the byte offsets of the lines
+containing it: latin text is split into words, Chinese/Japanese/Korean text
+into single characters and bigrams, since it has no spaces to split on.
+Closed segments save their index next to the log (`.idx`, marshal format),
+so startup only reads indexes, and a last-seen index points straight at
+the latest line of everyone who spoke, per channel.  Searching intersects
+postings newest segment first and reads only the lines it returns.
+
+Queries are asked from one channel of one network and only answer with
+lines from there, so channels and networks do not see each other's
+history; lines without a network match the channel on any network.
+
+Lines are added from the logger's writer thread; a lock guards the index
+against the reactor thread's queries.
+"""
+import bisect
+import marshal
+import os
+import re
+import threading
+import time
+from array import array
+
+from core.nicks import casefold
+from core.store import atomicWrite
+
+
+CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN = re.compile(u'([%s]+)|([^\\W%s]+)' % (CJK, CJK), re.U)
+
+
+def tokens(text, query=False):
+    """
+    The index terms of unicode <text>.  Documents index every CJK character
+    and bigram; queries only need the bigrams of runs longer than one.
+    """
+    result = set()
+    for cjk, word in TOKEN.findall(text.lower()):
+        if word:
+            result.add(word)
+        elif len(cjk) == 1 or not query:
+            result.update(cjk)
+        if len(cjk) > 1:
+            result.update(cjk[i:i + 2] for i in xrange(len(cjk) - 1))
+    return result
+
+
+def parse(line):
+    """ (timestamp, network, channel, nick, message) of a segment line """
+    ts, where, nick, msg = line.rstrip('\n').split('\t', 3)
+    network, _, channel = where.decode('utf-8').rpartition(u' ')
+    return int(ts), network, channel, nick.decode('utf-8'), msg.decode('utf-8')
+
+
+def seenKey(network, channel, nick):
+    """ The key of the last-seen index for <nick> on a channel """
+    return u'%s\t%s\t%s' % (network, casefold(channel), nick.lower())
+
+
+
+class Segment(object):
+    """ One day of history and its index """
+
+    def __init__(self, path, day):
+        self.path = path
+        self.day = day
+        self.postings = {}      # term -> array of line offsets, ascending
+        self.size = 0
+
+
+    @property
+    def indexPath(self):
+        return self.path[:-len('.log')] + '.idx'
+
+
+    def add(self, offset, terms):
+        postings = self.postings
+        for t in terms:
+            p = postings.get(t)
+            if p is None:
+                p = postings[t] = array('I')
+            p.append(offset)
+
+
+    def lookup(self, terms):
+        """ Offsets of lines containing every term, newest first """
+        lists = []
+        for t in terms:
+            p = self.postings.get(t)
+            if p is None:
+                return []
+            lists.append(p)
+        lists.sort(key=len)
+        hits = set(lists[0])
+        for p in lists[1:]:
+            hits.intersection_update(p)
+        return sorted(hits, reverse=True)
+
+
+    def save(self):
+        data = dict((t.encode('utf-8'), p.tostring())
+                    for t, p in self.postings.iteritems())
+        atomicWrite(self.indexPath, marshal.dumps((self.size, data)))
+
+
+    def load(self):
+        """ Read the saved index, or rebuild it if it is missing or stale """
+        size = os.path.getsize(self.path)
+        try:
+            with open(self.indexPath, 'rb') as f:
+                saved, data = marshal.loads(f.read())
+        except (IOError, EOFError, ValueError, TypeError):
+            saved = None
+        if saved == size:
+            for t, raw in data.iteritems():
+                p = array('I')
+                p.fromstring(raw)
+                self.postings[t.decode('utf-8')] = p
+            self.size = size
+            return None
+        return self.rebuild()
+
+
+    def rebuild(self):
+        """ Index the segment file from scratch; returns its last lines by nick """
+        self.postings = {}
+        latest = {}
+        offset = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break       # a torn last line after a crash
+                try:
+                    ts, network, channel, nick, msg = parse(line)
+                except ValueError:
+                    offset += len(line)
+                    continue
+                self.add(offset, tokens(msg))
+                latest[seenKey(network, channel, nick)] = [ts, nick, channel, self.day, offset]
+                offset += len(line)
+        self.size = offset
+        return latest
+
+
+
+class History(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.segments = []      # oldest first
+        self.byDay = {}
+        self.file = None
+        self.open = None        # the segment self.file appends to
+        self.seenPath = os.path.join(directory, 'seen.marshal')
+        self.seen = {}          # seenKey() -> [ts, nick, channel, day, offset]
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._load()
+
+
+    @classmethod
+    def fromConfig(cls, c):
+        from core.config import option
+        return cls(option(c, 'history', 'dir', 'log/history'))
+
+
+    def _load(self):
+        try:
+            with open(self.seenPath, 'rb') as f:
+                self.seen = marshal.loads(f.read())
+        except (IOError, EOFError, ValueError, TypeError):
+            self.seen = {}
+        for nick, entry in self.seen.items():
+            if u'\t' not in nick:
+                # saved when nicks were only known by name
+                del self.seen[nick]
+                self.seen[seenKey(u'', entry[2], nick)] = entry
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.log'):
+                continue
+            segment = Segment(os.path.join(self.directory, name), name[:-len('.log')])
+            latest = segment.load()
+            if latest:
+                # the index was stale, so last-seen may be too
+                for nick, entry in latest.iteritems():
+                    if nick not in self.seen or self.seen[nick][0] <= entry[0]:
+                        self.seen[nick] = entry
+            self.segments.append(segment)
+            self.byDay[segment.day] = segment
+
+
+    def _current(self, day):
+        """
+        The segment new lines for <day> go to.  Around midnight the writer
+        threads of several logs can hand in lines of both days in turn, so
+        the open file is not always the newest segment's.
+        """
+        if self.open is not None and self.open.day == day:
+            return self.open
+        self._closeFile()
+        segment = self.byDay.get(day)
+        if segment is None:
+            segment = Segment(os.path.join(self.directory, day + '.log'), day)
+            # keep the segments in order of day, as search() expects
+            days = [s.day for s in self.segments]
+            self.segments.insert(bisect.bisect(days, day), segment)
+            self.byDay[day] = segment
+        self.file = open(segment.path, 'ab')
+        # drop a torn line left by a crash so offsets stay right
+        self.file.truncate(segment.size)
+        self.open = segment
+        return segment
+
+
+    def _closeFile(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.open.save()
+            self.open = None
+            self._saveSeen()
+
+
+    def _saveSeen(self):
+        atomicWrite(self.seenPath, marshal.dumps(self.seen))
+
+
+    def add(self, ts, network, channel, nick, msg):
+        """ Record one channel line; network, channel, nick, msg as unicode """
+        with self.lock:
+            day = time.strftime('%Y-%m-%d', time.localtime(ts))
+            segment = self._current(day)
+            where = u'%s %s' % (network, channel) if network else channel
+            line = u'%d\t%s\t%s\t%s\n' % (ts, where, nick, msg.replace(u'\n', u' '))
+            line = line.encode('utf-8')
+            offset = segment.size
+            self.file.write(line)
+            segment.size += len(line)
+            segment.add(offset, tokens(msg))
+            self.seen[seenKey(network, channel, nick)] = [ts, nick, channel, day, offset]
+
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+
+    def close(self):
+        with self.lock:
+            self._closeFile()
+
+
+    def _read(self, day, offset):
+        segment = self.byDay[day]
+        if segment is self.open:
+            self.file.flush()
+        with open(segment.path, 'rb') as f:
+            f.seek(offset)
+            return parse(f.readline())
+
+
+    def search(self, query, network, channel, limit=3):
+        """
+        The newest lines on <channel> of <network> containing every word of
+        <query>, as (timestamp, channel, nick, message)
+        """
+        channel = casefold(channel)
+        terms = tokens(query, query=True)
+        words = query.lower().split()
+        results = []
+        if not terms:
+            return results
+        with self.lock:
+            for segment in reversed(self.segments):
+                for offset in segment.lookup(terms):
+                    ts, where, said, nick, msg = self._read(segment.day, offset)
+                    if where not in (network, u'') or casefold(said) != channel:
+                        continue
+                    # bigrams can match across words; check the real text
+                    text = msg.lower()
+                    if all(w in text for w in words):
+                        results.append((ts, said, nick, msg))
+                        if len(results) == limit:
+                            return results
+        return results
+
+
+    def _latest(self, nick, network, channel):
+        """ The last-seen entry of <nick> on <channel> of <network>, or None """
+        entries = [self.seen.get(seenKey(where, channel, nick)) for where in (network, u'')]
+        entries = [e for e in entries if e is not None]
+        return max(entries) if entries else None
+
+
+    def lastSeen(self, nick, network, channel):
+        """ (timestamp, nick, channel) of nick's latest line on <channel>, or None """
+        with self.lock:
+            entry = self._latest(nick, network, channel)
+        if entry is None:
+            return None
+        return tuple(entry[:3])
+
+
+    def last(self, nick, network, channel):
+        """
+        (timestamp, channel, nick, message) of nick's latest line on
+        <channel>, or None
+        """
+        with self.lock:
+            entry = self._latest(nick, network, channel)
+            if entry is None or entry[3] not in self.byDay:
+                return None
+            ts, where, said, nick, msg = self._read(entry[3], entry[4])
+            return ts, said, nick, msg
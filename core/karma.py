@@ -0,0 +1,199 @@
+"""
+Append-only journal of karma (`nick++`) events.
+
+Every point given is appended to the journal as one tab separated line:
+
+    timestamp  giver  receiver  channel
+
+Running totals still live in user_info.json, which serves as the snapshot;
+the journal is compacted periodically to the events that can still matter
+for the longest rolling window.  On top of it, per-window totals (day, week,
+month) and a short per-user history are maintained incrementally as events
+arrive and expire, so `top10 week` never rescans the journal.  Like the
+user table, they know a nick by its RFC 1459 case-folded form, so "Bob"
+and "bob" share their points; the journal keeps nicks as they were typed.
+"""
+import heapq
+import os
+import time
+from collections import Counter, deque
+from operator import itemgetter
+
+from twisted.internet import reactor, task
+
+from core.nicks import casefold, text
+from core.store import atomicWrite, FLUSH_SECONDS
+
+
+WINDOWS = {
+    'day': 24 * 3600,
+    'week': 7 * 24 * 3600,
+    'month': 30 * 24 * 3600,
+}
+
+
+class Window(object):
+    """ Points received per nick over the last <span> seconds """
+
+    def __init__(self, span):
+        self.span = span
+        self.events = deque()       # (timestamp, receiver), oldest first
+        self.totals = Counter()
+
+
+    def add(self, ts, receiver):
+        self.events.append((ts, receiver))
+        self.totals[receiver] += 1
+
+
+    def expire(self, now):
+        events, totals = self.events, self.totals
+        horizon = now - self.span
+        while events and events[0][0] <= horizon:
+            _, receiver = events.popleft()
+            totals[receiver] -= 1
+            if not totals[receiver]:
+                del totals[receiver]
+
+
+    def top(self, n):
+        return heapq.nlargest(n, self.totals.iteritems(), key=itemgetter(1))
+
+
+
+class KarmaJournal(object):
+
+    def __init__(self, path, history=20, flush_delay=1.0,
+                 compact_interval=24 * 3600, clock=time.time):
+        self.path = path
+        self.history_size = history
+        self.flush_delay = flush_delay
+        self.clock = clock
+        self.windows = dict((name, Window(span)) for name, span in WINDOWS.items())
+        self.horizon = max(WINDOWS.values())
+        self.history = {}           # folded receiver -> deque of (ts, giver, channel)
+        self.count = 0              # events in the journal file
+        self.delayed = None
+        self.replay()
+        self.file = open(self.path, 'ab')
+        self.compactor = task.LoopingCall(self.compact)
+        self.compact_interval = compact_interval
+
+
+    @classmethod
+    def fromConfig(cls, c):
+        from core.config import option
+        return cls(option(c, 'karma', 'journal', 'files/karma.log'),
+                   history=option(c, 'karma', 'history', 20),
+                   compact_interval=option(c, 'karma', 'compact_interval', 24 * 3600.0))
+
+
+    def replay(self):
+        """ Rebuild the windows from the events still in the journal """
+        if not os.path.exists(self.path):
+            return
+        horizon = self.clock() - self.horizon
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    ts, giver, receiver, channel = line.rstrip('\n').split('\t')
+                    ts = int(ts)
+                except ValueError:
+                    continue    # a torn last line after a crash
+                self.count += 1
+                if ts > horizon:
+                    self._index(ts, giver.decode('utf-8'),
+                            receiver.decode('utf-8'), channel.decode('utf-8'))
+
+
+    def start(self):
+        if not self.compactor.running:
+            self.compactor.start(self.compact_interval, now=False)
+
+
+    def stop(self):
+        if self.compactor.running:
+            self.compactor.stop()
+
+
+    def record(self, giver, receiver, channel):
+        """ Journal one point given by giver to receiver """
+        giver, receiver, channel = [text(s) for s in (giver, receiver, channel)]
+        ts = int(self.clock())
+        line = u'\t'.join([str(ts), giver, receiver, channel]) + u'\n'
+        self.file.write(line.encode('utf-8'))
+        self.count += 1
+        self._index(ts, giver, receiver, channel)
+        if self.delayed is None:
+            self.delayed = reactor.callLater(self.flush_delay, self.flush)
+
+
+    def _index(self, ts, giver, receiver, channel):
+        receiver = casefold(receiver)
+        for w in self.windows.itervalues():
+            w.add(ts, receiver)
+        if receiver not in self.history:
+            self.history[receiver] = deque(maxlen=self.history_size)
+        self.history[receiver].append((ts, giver, channel))
+
+
+    def top(self, window, n=10):
+        """ [(folded nick, points)] for the n nicks with most points in the window """
+        w = self.windows[window]
+        w.expire(self.clock())
+        return w.top(n)
+
+
+    def points(self, receiver):
+        """ {window: points received in it} for one nick """
+        receiver = casefold(receiver)
+        now = self.clock()
+        result = {}
+        for name, w in self.windows.iteritems():
+            w.expire(now)
+            result[name] = w.totals.get(receiver, 0)
+        return result
+
+
+    def recent(self, receiver):
+        """ The latest (timestamp, giver, channel) events for one nick """
+        return list(self.history.get(casefold(receiver), ()))
+
+
+    def flush(self):
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+        self.file.flush()
+
+
+    def compact(self):
+        """
+        Rewrite the journal keeping only events inside the longest window.
+        Older points are already part of the user_info.json totals.
+        """
+        self.flush()
+        w = self.windows['month']
+        w.expire(self.clock())
+        if self.count == len(w.events):
+            return
+        start = time.time()
+        lines = []
+        with open(self.path, 'rb') as f:
+            horizon = self.clock() - self.horizon
+            for line in f:
+                try:
+                    if int(line.split('\t', 1)[0]) > horizon:
+                        lines.append(line)
+                except ValueError:
+                    pass
+        self.file.close()
+        atomicWrite(self.path, ''.join(lines))
+        self.file = open(self.path, 'ab')
+        self.count = len(lines)
+        FLUSH_SECONDS.observe(time.time() - start, os.path.basename(self.path))
+
+
+    def close(self):
+        self.flush()
+        self.file.close()
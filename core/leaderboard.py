@@ -0,0 +1,169 @@
+"""
+All-time karma leaderboard, maintained incrementally.  Only nicks with
+points are on it.
+
+Nicks with the same number of points share a bucket, kept sorted by nick so
+ties have a stable order.  The distinct point values are kept in a sorted
+list, and a Fenwick tree over point values counts how many nicks have at
+most p points.  Giving a point moves one nick between two buckets and
+updates the tree in O(log n); `top`, `rank` and `around` never look at
+more buckets than they return.
+"""
+from bisect import bisect_left, insort
+
+from core.nicks import text
+
+
+class Fenwick(object):
+    """ Counts per point value, with prefix sums in O(log size) """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+
+    def add(self, value, delta):
+        if value >= self.size:
+            self._grow(value)
+        i = value + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+
+    def prefix(self, value):
+        """ How many entries have a value <= value """
+        i = min(value, self.size - 1) + 1
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
+    def _grow(self, value):
+        counts = [self.prefix(v) - self.prefix(v - 1) for v in xrange(self.size)]
+        size = self.size
+        while size <= value:
+            size *= 2
+        self.size = size
+        self.tree = [0] * (size + 1)
+        for v, n in enumerate(counts):
+            if n:
+                self.add(v, n)
+
+
+
+class Leaderboard(object):
+
+    def __init__(self):
+        self.points = {}        # nick -> points
+        self.buckets = {}       # points -> sorted list of nicks
+        self.values = []        # distinct point values, ascending
+        self.counts = Fenwick()
+
+
+    @classmethod
+    def fromUsers(cls, users):
+        """ Build the index from a core.users.UserTable """
+        board = cls()
+        for nick, points in users.scores():
+            board.set(nick, points)
+        return board
+
+
+    def __len__(self):
+        return len(self.points)
+
+
+    def set(self, nick, points):
+        nick = text(nick)
+        points = max(int(points), 0)
+        if nick in self.points:
+            if self.points[nick] == points:
+                return
+            self._remove(nick, self.points[nick])
+        if points:
+            self._insert(nick, points)
+
+
+    def increment(self, nick, by=1):
+        nick = text(nick)
+        self.set(nick, self.points.get(nick, 0) + by)
+
+
+    def _insert(self, nick, points):
+        bucket = self.buckets.get(points)
+        if bucket is None:
+            bucket = self.buckets[points] = []
+            insort(self.values, points)
+        insort(bucket, nick)
+        self.points[nick] = points
+        self.counts.add(points, 1)
+
+
+    def _remove(self, nick, points):
+        bucket = self.buckets[points]
+        del bucket[bisect_left(bucket, nick)]
+        if not bucket:
+            del self.buckets[points]
+            del self.values[bisect_left(self.values, points)]
+        del self.points[nick]
+        self.counts.add(points, -1)
+
+
+    def rank(self, nick):
+        """ 1-based position of nick, or None for an unknown nick """
+        nick = text(nick)
+        if nick not in self.points:
+            return None
+        points = self.points[nick]
+        above = len(self.points) - self.counts.prefix(points)
+        return above + bisect_left(self.buckets[points], nick) + 1
+
+
+    def top(self, n=10):
+        """ [(nick, points)] for the first n places """
+        result = []
+        for i in xrange(len(self.values) - 1, -1, -1):
+            points = self.values[i]
+            for nick in self.buckets[points]:
+                if len(result) == n:
+                    return result
+                result.append((nick, points))
+        return result
+
+
+    def around(self, nick, k=2):
+        """
+        [(rank, nick, points)] for nick and up to k places on either side
+        """
+        nick = text(nick)
+        rank = self.rank(nick)
+        if rank is None:
+            return []
+        points = self.points[nick]
+        v = bisect_left(self.values, points)
+        bucket = self.buckets[points]
+        i = bisect_left(bucket, nick)
+
+        # places above, walking towards higher point values
+        above = [(n, points) for n in bucket[max(i - k, 0):i]]
+        w = v + 1
+        while len(above) < k and w < len(self.values):
+            p = self.values[w]
+            need = k - len(above)
+            above = [(n, p) for n in self.buckets[p][-need:]] + above
+            w += 1
+
+        # places below, walking towards lower point values
+        below = [(n, points) for n in bucket[i + 1:i + 1 + k]]
+        w = v - 1
+        while len(below) < k and w >= 0:
+            p = self.values[w]
+            below += [(n, p) for n in self.buckets[p][:k - len(below)]]
+            w -= 1
+
+        entries = above + [(nick, points)] + below
+        first = rank - len(above)
+        return [(first + j, n, p) for j, (n, p) in enumerate(entries)]
@@ -0,0 +1,229 @@
+"""
+An independent logger class (because separation of application
+and protocol logic is a good thing).
+
+Lines are timestamped on the calling thread and handed to a writer thread,
+which batches them and writes once `flush_lines` lines are waiting or
+`flush_interval` seconds have passed.  The log file can be rotated when it
+grows past `max_bytes` or when the date changes, optionally gzipping the
+closed segment.  close() drains the queue, so nothing logged before it is
+lost; flush() does the same but leaves the file open for more.  A failed write or rotation (a full disk, say) is reported and the
+batch dropped, but the writer thread carries on.
+
+Channel lines logged with chat() are also handed, from the writer thread,
+to an optional sink such as core.history.History.
+"""
+import gzip
+import os
+import shutil
+import threading
+import time
+import traceback
+import Queue
+
+from core import metrics
+from core.store import FLUSH_SECONDS
+
+
+WRITE_ERRORS = metrics.counter('log_write_errors_total',
+                               'Batches of log lines that could not be written', ('log', ))
+
+
+_CLOSE = object()
+
+
+class _Flush(object):
+    """ Queued by flush(); set once everything before it is written """
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class MessageLogger(object):
+
+    def __init__(self, path, flush_lines=100, flush_interval=1.0,
+                 max_bytes=0, daily=False, compress=False, sink=None):
+        self.path = path
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.daily = daily
+        self.compress = compress
+        self.sink = sink
+        self.queue = Queue.Queue()
+        self.written = 0
+        self.rotations = 0
+        self.errors = 0
+        self._second = None
+        self._stamp = None
+        self.file = open(path, 'a')
+        self.day = self._today()
+        self.thread = threading.Thread(target=self._run, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    @classmethod
+    def fromConfig(cls, path, c, sink=None):
+        """ A logger for <path> using the [log] section of config.cfg """
+        from core.config import option
+        return cls(path, sink=sink,
+                   flush_lines=option(c, 'log', 'flush_lines', 100),
+                   flush_interval=option(c, 'log', 'flush_interval', 1.0),
+                   max_bytes=option(c, 'log', 'max_bytes', 0),
+                   daily=option(c, 'log', 'daily', False),
+                   compress=option(c, 'log', 'compress', False))
+
+
+    def log(self, message, record=None):
+        """Write a message to the file."""
+        if message.strip() == '': return
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        now = time.time()
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._stamp = time.strftime("[%H:%M:%S]", time.localtime(now))
+        line = '%s %s\n' % (self._stamp, message)
+        if record is not None and self.sink is not None:
+            self.queue.put((line, (second, ) + record))
+        else:
+            self.queue.put(line)
+
+
+    def chat(self, channel, nick, msg, network=''):
+        """ Log what <nick> said on <channel>, and pass it on to the sink """
+        self.log("<%s> %s" % (nick, msg), (network, channel, nick, msg))
+
+
+    def queueDepth(self):
+        """ Lines logged but not written yet """
+        return self.queue.qsize()
+
+
+    def flush(self):
+        """ Write everything queued so far, and wait until it is written """
+        if not self.thread.is_alive():
+            return
+        marker = _Flush()
+        self.queue.put(marker)
+        while not marker.done.wait(1.0):
+            if not self.thread.is_alive():
+                return
+
+
+    def close(self):
+        """ Write everything still queued and close the file """
+        if self.thread.is_alive():
+            self.queue.put(_CLOSE)
+            self.thread.join()
+
+
+    def _run(self):
+        lines = []
+        records = []
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.time(), 0)
+            try:
+                line = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                line = None
+            if line is _CLOSE:
+                try:
+                    self._write(lines, records)
+                finally:
+                    self.file.close()
+                return
+            if isinstance(line, _Flush):
+                try:
+                    self._write(lines, records)
+                finally:
+                    line.done.set()
+                lines = []
+                records = []
+                deadline = None
+                continue
+            if isinstance(line, tuple):
+                line, record = line
+                records.append(record)
+            if line is not None:
+                lines.append(line)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+            if lines and (len(lines) >= self.flush_lines or time.time() >= deadline):
+                self._write(lines, records)
+                lines = []
+                records = []
+                deadline = None
+
+
+    def _write(self, lines, records=()):
+        if not lines:
+            return
+        start = time.time()
+        try:
+            if self.file.closed:
+                self.file = open(self.path, 'a')    # reopening failed last time
+            if self.daily and self._today() != self.day:
+                self._rotate()
+            self.file.write(''.join(lines))
+            self.file.flush()
+            self.written += len(lines)
+            if self.max_bytes and self.file.tell() >= self.max_bytes:
+                self._rotate()
+        except (IOError, OSError, ValueError):
+            # a dead writer thread would leave log() queueing forever
+            self.errors += 1
+            WRITE_ERRORS.inc(os.path.basename(self.path))
+            traceback.print_exc()
+        if records:
+            try:
+                for ts, network, channel, nick, msg in records:
+                    self.sink.add(ts, *[s.decode('utf-8', 'replace')
+                                        for s in (network, channel, nick, msg)])
+                self.sink.flush()
+            except Exception:
+                # keep logging even if the sink breaks
+                traceback.print_exc()
+        FLUSH_SECONDS.observe(time.time() - start, os.path.basename(self.path))
+
+
+    def _today(self):
+        return time.strftime('%Y-%m-%d')
+
+
+    def _rotate(self):
+        """ Move the current file aside and start a new one """
+        try:
+            self.file.close()
+            segment = '%s.%s' % (self.path, time.strftime('%Y%m%d-%H%M%S'))
+            n = 1
+            while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+                segment = '%s.%s-%d' % (self.path, time.strftime('%Y%m%d-%H%M%S'), n)
+                n += 1
+            os.rename(self.path, segment)
+            self.rotations += 1
+        finally:
+            # even if the rename failed, carry on with a file to write to,
+            # and do not try again before the next rotation is due
+            self.file = open(self.path, 'a')
+            self.day = self._today()
+        if self.compress:
+            self._compress(segment)
+
+
+    def _compress(self, segment):
+        """ gzip a closed segment, leaving it as it is if that fails """
+        try:
+            with open(segment, 'rb') as src:
+                with gzip.open(segment + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+        except (IOError, OSError):
+            if os.path.exists(segment + '.gz'):
+                os.unlink(segment + '.gz')
+            raise
+        os.unlink(segment)
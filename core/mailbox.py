@@ -0,0 +1,159 @@
+"""
+Messages left with `tell`, delivered when the recipient next shows up.
+
+Mail is kept in the messages JsonStore as
+
+    {"version": 2, "boxes": {nick: [[sent at, sender, line], ...]}}
+
+keyed by the RFC 1459 case-folded recipient, so "Bob" and "bob" share a
+mailbox and checking whether someone who joins or speaks has mail is one
+dict lookup.  Lines are delivered oldest first.  Each sender may have at
+most `per_sender` messages waiting and each recipient at most
+`per_recipient`; mail nobody collected within `expire_days` is dropped by
+an hourly sweep, so the file stays bounded.
+
+The old format, {nick: [line, ...]}, is converted when first loaded.
+"""
+from twisted.internet import reactor, task
+
+from core.nicks import casefold
+
+
+class MailboxFull(Exception):
+    """ A quota would be exceeded; the message says which """
+
+
+
+class Mailbox(object):
+
+    def __init__(self, store, per_sender=10, per_recipient=20, expire_days=30.0,
+                 clock=reactor):
+        """
+        @param store: the JsonStore holding the mail
+        """
+        self.store = store
+        self.per_sender = per_sender
+        self.per_recipient = per_recipient
+        self.expiry = expire_days * 86400
+        self.clock = clock
+        self._boxes = None
+        self.senders = {}       # case-folded sender -> messages waiting
+        self.sweeper = task.LoopingCall(self.expire)
+        self.sweeper.clock = clock
+
+
+    @classmethod
+    def fromConfig(cls, c, store):
+        from core.config import option
+        return cls(store,
+                   per_sender=option(c, 'mailbox', 'per_sender', 10),
+                   per_recipient=option(c, 'mailbox', 'per_recipient', 20),
+                   expire_days=option(c, 'mailbox', 'expire_days', 30.0))
+
+
+    @property
+    def boxes(self):
+        """ Only loaded from disk when first needed """
+        if self._boxes is None:
+            self._boxes = self._load()
+        return self._boxes
+
+
+    def _load(self):
+        data = self.store.data
+        if data.get('version') != 2:
+            self._migrate(data)
+        for mail in data['boxes'].itervalues():
+            for sent, sender, line in mail:
+                self._count(sender, 1)
+        return data['boxes']
+
+
+    def _migrate(self, data):
+        """ Convert {nick: [line, ...]} in place; old mail has no sender """
+        now = self.clock.seconds()
+        boxes = {}
+        for nick, lines in data.items():
+            if isinstance(lines, list):
+                boxes.setdefault(casefold(nick), []).extend(
+                        [now, u'', line] for line in lines)
+        data.clear()
+        data['version'] = 2
+        data['boxes'] = boxes
+        self.store.markDirty()
+
+
+    def _count(self, sender, n):
+        if not sender:
+            return
+        sender = casefold(sender)
+        count = self.senders.get(sender, 0) + n
+        if count > 0:
+            self.senders[sender] = count
+        else:
+            self.senders.pop(sender, None)
+
+
+    def start(self):
+        if not self.sweeper.running:
+            self.sweeper.start(3600, now=False)
+
+
+    def stop(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+
+
+    def send(self, sender, recipient, line):
+        """ Leave <line> for <recipient>; raises MailboxFull over a quota """
+        if self.senders.get(casefold(sender), 0) >= self.per_sender:
+            raise MailboxFull('you already have %d messages waiting' % (self.per_sender, ))
+        mail = self.boxes.get(casefold(recipient), [])
+        if len(mail) >= self.per_recipient:
+            raise MailboxFull('%s already has %d messages waiting' % (
+                    recipient, self.per_recipient))
+        mail.append([self.clock.seconds(), sender, line])
+        self.boxes[casefold(recipient)] = mail
+        self._count(sender, 1)
+        self.store.markDirty()
+
+
+    def has(self, nick):
+        """ Is mail waiting for <nick>? """
+        boxes = self.boxes
+        return bool(boxes) and casefold(nick) in boxes
+
+
+    def take(self, nick):
+        """ The lines waiting for <nick>, oldest first, removing them """
+        mail = self.boxes.pop(casefold(nick), None)
+        if mail is None:
+            return []
+        self.store.markDirty()
+        oldest = self.clock.seconds() - self.expiry
+        for sent, sender, line in mail:
+            self._count(sender, -1)
+        return [line for sent, sender, line in mail if sent >= oldest]
+
+
+    def expire(self):
+        """ Drop mail older than expire_days """
+        oldest = self.clock.seconds() - self.expiry
+        dropped = 0
+        for nick, mail in self.boxes.items():
+            keep = [m for m in mail if m[0] >= oldest]
+            for sent, sender, line in mail:
+                if sent < oldest:
+                    self._count(sender, -1)
+            dropped += len(mail) - len(keep)
+            if keep:
+                self.boxes[nick] = keep
+            else:
+                del self.boxes[nick]
+        if dropped:
+            self.store.markDirty(dropped)
+        return dropped
+
+
+    def __len__(self):
+        return sum(len(mail) for mail in self.boxes.itervalues())
@@ -0,0 +1,113 @@
+"""
+The cafe's menu of the day, kept in memory for the `cafe` command.
+
+The menu changes once per business day, so a scraped menu is kept until
+midnight before the next business day (Monday to Friday) and `cafe` answers
+from memory.  Optionally the menu is prefetched every business day at a
+configured time before lunch, so nobody waits on the scrape.
+"""
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+def nextBusinessDay(t):
+    """ Local midnight starting the first business day after time <t> """
+    n = 1
+    while time.localtime(t + n * 86400).tm_wday >= 5:
+        n += 1
+    day = time.localtime(t + n * 86400)
+    return time.mktime((day.tm_year, day.tm_mon, day.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+def nextPrefetch(t, hour, minute):
+    """ The first business day <hour>:<minute> after time <t> """
+    day = time.localtime(t)
+    at = time.mktime((day.tm_year, day.tm_mon, day.tm_mday, hour, minute, 0, 0, 0, -1))
+    if at > t and day.tm_wday < 5:
+        return at
+    day = time.localtime(nextBusinessDay(t))
+    return time.mktime((day.tm_year, day.tm_mon, day.tm_mday, hour, minute, 0, 0, 0, -1))
+
+
+
+class DailyMenu(object):
+
+    def __init__(self, fetch, prefetch=None, clock=reactor):
+        """
+        @param fetch: fetch(), a Deferred firing with the menu
+        @param prefetch: (hour, minute) to fetch the menu at, or None
+        """
+        self.fetch = fetch
+        self.prefetch = prefetch
+        self.clock = clock
+        self.menu = None
+        self.expires = 0
+        self.pending = None     # Deferreds waiting on a fetch
+        self.delayed = None
+        self.fetches = 0
+
+
+    @classmethod
+    def fromConfig(cls, c, fetch):
+        from core.config import option
+        prefetch = option(c, 'cafe', 'prefetch', '')
+        if prefetch:
+            hour, minute = prefetch.split(':')
+            prefetch = (int(hour), int(minute))
+        return cls(fetch, prefetch or None)
+
+
+    def start(self):
+        if self.prefetch is not None and self.delayed is None:
+            self._schedule()
+
+
+    def stop(self):
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+
+
+    def _schedule(self):
+        now = self.clock.seconds()
+        wait = nextPrefetch(now, *self.prefetch) - now
+        self.delayed = self.clock.callLater(wait, self._prefetch)
+
+
+    def _prefetch(self):
+        self.refresh().addErrback(log.err)
+        self._schedule()
+
+
+    def lookup(self):
+        """ A Deferred firing with today's menu, scraped only if needed """
+        if self.menu is not None and self.clock.seconds() < self.expires:
+            return defer.succeed(self.menu)
+        return self.refresh()
+
+
+    def refresh(self):
+        """ Scrape the menu again; concurrent callers share one scrape """
+        d = defer.Deferred()
+        if self.pending is not None:
+            self.pending.append(d)
+            return d
+        self.pending = [d]
+
+        def done(menu):
+            self.menu = menu
+            self.expires = nextBusinessDay(self.clock.seconds())
+            self.fetches += 1
+            waiting, self.pending = self.pending, None
+            for waiter in waiting:
+                waiter.callback(menu)
+
+        def failed(failure):
+            waiting, self.pending = self.pending, None
+            for waiter in waiting:
+                waiter.errback(failure)
+
+        self.fetch().addCallbacks(done, failed)
+        return d
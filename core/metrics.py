@@ -0,0 +1,208 @@
+"""
+Counters and latency histograms for the bot, cheap enough to leave on.
+
+Modules declare their metrics once at import time:
+
+    FLUSHES = metrics.histogram('persist_flush_seconds',
+                                'Time to write persisted state', ('store', ))
+
+and record into them with FLUSHES.observe(seconds, 'user_info').  Metrics
+may be updated from any thread.  render() gives everything in the
+Prometheus text format, which listen() serves over HTTP for scraping; the
+admin `stats` command summarizes the same data in chat.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from twisted.python import failure
+
+
+# seconds; handlers are usually sub-millisecond, backends up to the timeout
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % (','.join(pairs), ) if pairs else ''
+
+
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}        # label values -> count
+        self.lock = threading.Lock()
+
+
+    def inc(self, *labels, **kwargs):
+        n = kwargs.get('n', 1)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+
+    def render(self):
+        for labels, value in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name, _labels(self.labels, labels), value)
+
+
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}        # label values -> [per-bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, *labels):
+        with self.lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            v[0][bisect_left(self.buckets, value)] += 1
+            v[1] += value
+            v[2] += 1
+
+
+    def count(self, *labels):
+        v = self.values.get(labels)
+        return v[2] if v else 0
+
+
+    def quantile(self, q, *labels):
+        """ Estimate of the <q> quantile, interpolated within its bucket """
+        v = self.values.get(labels)
+        if not v or not v[2]:
+            return 0.0
+        rank = q * v[2]
+        seen = 0
+        for i, n in enumerate(v[0]):
+            if n and seen + n >= rank:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+    def render(self):
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '%s_bucket%s %d' % (self.name, _labels(self.labels, labels,
+                                          'le="%g"' % (bound, )), cumulative)
+            yield '%s_bucket%s %d' % (self.name, _labels(self.labels, labels,
+                                      'le="+Inf"'), count)
+            yield '%s_sum%s %r' % (self.name, _labels(self.labels, labels), total)
+            yield '%s_count%s %d' % (self.name, _labels(self.labels, labels), count)
+
+
+
+class Gauge(object):
+    """
+    A value read from a callable when rendered; with <labels>, the callable
+    returns {label values: value}
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, f, labels=()):
+        self.name = name
+        self.help = help
+        self.f = f
+        self.labels = labels
+
+
+    def render(self):
+        if not self.labels:
+            yield '%s %s' % (self.name, self.f())
+            return
+        for labels, value in sorted(self.f().items()):
+            yield '%s%s %s' % (self.name, _labels(self.labels, labels), value)
+
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.append('# HELP %s %s' % (m.name, m.help))
+            lines.append('# TYPE %s %s' % (m.name, m.kind))
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labels=()):
+    return REGISTRY.add(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=BUCKETS):
+    return REGISTRY.add(Histogram(name, help, labels, buckets))
+
+
+def gauge(name, help, f, labels=()):
+    return REGISTRY.add(Gauge(name, help, f, labels))
+
+
+def timeDeferred(d, seconds, errors, *labels):
+    """ Observe how long Deferred <d> takes, and count it if it fails """
+    start = time.time()
+    def done(result):
+        seconds.observe(time.time() - start, *labels)
+        if isinstance(result, failure.Failure):
+            errors.inc(*labels)
+        return result
+    return d.addBoth(done)
+
+
+def listen(port, interface='127.0.0.1', registry=REGISTRY):
+    """ Serve the registry for Prometheus at http://<interface>:<port>/metrics """
+    from twisted.internet import reactor
+    from twisted.web import resource, server
+
+    class Metrics(resource.Resource):
+        isLeaf = True
+
+        def render_GET(self, request):
+            request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+            return registry.render()
+
+    return reactor.listenTCP(port, server.Site(Metrics()), interface=interface)
@@ -0,0 +1,104 @@
+"""
+The networks and channels to join, read from config.cfg.
+
+One process can serve several networks, each with several channels:
+
+    [network:freenode]
+    server=irc.freenode.net
+    port=6667
+    nickname=AL
+    logfile=log/freenode.log
+    channels=#test_ircbot, #g0v.tw
+
+    [channel:freenode/#g0v.tw]
+    logfile=log/g0v.log
+    cafe=on
+
+A [channel:network/#name] section can give the channel its own log file and
+turn commands on or off, overriding [commands].  A config with only the old
+[irc] section is read as a single network called `irc` with one channel.
+"""
+from core.commands import CommandRegistry
+from core.config import option
+
+
+def channelName(name):
+    """ #name, as twisted's join() would send it """
+    name = name.strip()
+    if name and name[0] not in '#&!+':
+        name = '#' + name
+    return name
+
+
+
+class Channel(object):
+
+    def __init__(self, name, logfile, commands):
+        self.name = name
+        self.logfile = logfile
+        self.commands = commands
+
+
+
+class Network(object):
+
+    def __init__(self, name, server, port, nickname, logfile, channels, commands):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.nickname = nickname
+        self.logfile = logfile
+        self.channels = channels    # lower-case name -> Channel
+        self.commands = commands    # for private messages and plain channels
+
+
+    def channel(self, name):
+        """ The Channel called <name>, or None for private messages """
+        return self.channels.get(name.lower())
+
+
+    def enabledCommands(self):
+        """ The commands enabled anywhere on this network """
+        commands = set(self.commands.enabled)
+        for channel in self.channels.itervalues():
+            commands.update(channel.commands.enabled)
+        return commands
+
+
+
+def networks(c, handlers):
+    """
+    The Networks configured in ConfigParser <c>, with command registries
+    built from the @command methods of class <handlers>.
+    """
+    sections = [s for s in c.sections() if s.startswith('network:')]
+    result = []
+    if not sections:
+        commands = CommandRegistry(handlers, c)
+        name = channelName(c.get('irc', 'channel'))
+        logfile = c.get('irc', 'logfile')
+        channels = {name.lower(): Channel(name, logfile, commands)}
+        result.append(Network('irc', c.get('irc', 'server'), c.getint('irc', 'port'),
+                              c.get('irc', 'nickname'), logfile, channels, commands))
+        return result
+
+    for section in sections:
+        net = section[len('network:'):]
+        commands = CommandRegistry(handlers, c)
+        logfile = c.get(section, 'logfile')
+        channels = {}
+        for name in option(c, section, 'channels', '').split(','):
+            name = channelName(name)
+            if not name:
+                continue
+            override = 'channel:%s/%s' % (net, name)
+            if c.has_section(override):
+                channel = Channel(name, option(c, override, 'logfile', logfile),
+                                  CommandRegistry(handlers, c, override))
+            else:
+                channel = Channel(name, logfile, commands)
+            channels[name.lower()] = channel
+        result.append(Network(net, c.get(section, 'server'), c.getint(section, 'port'),
+                              option(c, section, 'nickname', 'AL'), logfile,
+                              channels, commands))
+    return result
@@ -0,0 +1,33 @@
+"""
+Helpers for handling IRC nicks.
+"""
+from string import maketrans
+
+
+def text(s):
+    """ Nicks arrive as UTF-8 bytes from twisted but as unicode from JSON """
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+# RFC 1459 casemapping: besides A-Z, []\\~ are the upper case of {}|^
+UPPER = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~'
+LOWER = 'abcdefghijklmnopqrstuvwxyz{}|^'
+RFC1459 = dict((ord(upper), ord(lower)) for upper, lower in zip(UPPER, LOWER))
+RFC1459_BYTES = maketrans(UPPER, LOWER)
+
+
+def casefold(nick):
+    """ The form of <nick> the server compares nicks in, as unicode """
+    if isinstance(nick, str):
+        # only ASCII changes, so folding the UTF-8 bytes is the same, and faster
+        return nick.translate(RFC1459_BYTES).decode('utf-8', 'replace')
+    return nick.translate(RFC1459)
+
+
+def fold(nick):
+    """ casefold() as UTF-8 bytes, the compact form to index nicks by """
+    if isinstance(nick, unicode):
+        nick = nick.encode('utf-8')
+    return nick.translate(RFC1459_BYTES)
@@ -0,0 +1,185 @@
+"""
+Rate-limited, prioritized outbound PRIVMSG queue.
+
+Everything the bot says goes through an OutboundQueue instead of straight
+to the socket.  A token bucket (`burst` lines, refilled at `rate` lines per
+second) keeps us under the server's flood limits.  Replies to commands are
+interactive and always go before bulk output like help text; within a
+priority, targets take turns one line at a time so a long answer to one
+channel does not hold up a short one to another.
+
+Long text is split into lines of at most `max_bytes` UTF-8 bytes, or fewer
+if `budget` says the server leaves less room for a target, at a space where
+possible and never inside a character; short lines of one
+message can be merged to save lines.  The time each line waits in the
+queue is recorded for latency statistics.
+"""
+import weakref
+from collections import deque, OrderedDict
+
+from twisted.internet import reactor
+
+from core import metrics
+
+
+INTERACTIVE = 0
+BULK = 1
+
+QUEUES = weakref.WeakSet()      # every live OutboundQueue, for the gauge
+
+SENT = metrics.counter('outbound_lines_total', 'Lines sent to IRC')
+WAIT_SECONDS = metrics.histogram('outbound_wait_seconds',
+                                 'Time lines waited in the outbound queue')
+metrics.gauge('outbound_queue_depth', 'Lines waiting to be sent',
+              lambda: sum(q.depth() for q in list(QUEUES)))
+
+
+def splitUtf8(text, max_bytes):
+    """ Split one line of UTF-8 bytes into pieces of at most max_bytes """
+    pieces = []
+    while len(text) > max_bytes:
+        cut = max_bytes
+        # never cut inside a multi-byte character
+        while cut > 0 and 0x80 <= ord(text[cut]) < 0xC0:
+            cut -= 1
+        if cut == 0:
+            cut = max_bytes     # not UTF-8 after all
+        space = text.rfind(' ', 0, cut + 1)
+        if space > max_bytes * 3 / 4:
+            pieces.append(text[:space])
+            text = text[space + 1:]
+        else:
+            pieces.append(text[:cut])
+            text = text[cut:]
+    pieces.append(text)
+    return pieces
+
+
+def lines(message, max_bytes, merge=False, separator=' | '):
+    """ The IRC lines needed to send <message> """
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    result = []
+    for line in message.split('\n'):
+        line = line.rstrip('\r')
+        if not line:
+            continue
+        for piece in splitUtf8(line, max_bytes):
+            if (merge and result and
+                    len(result[-1]) + len(separator) + len(piece) <= max_bytes):
+                result[-1] += separator + piece
+            else:
+                result.append(piece)
+    return result
+
+
+
+class OutboundQueue(object):
+
+    def __init__(self, send, rate=1.0, burst=5, max_bytes=400, budget=None, clock=reactor):
+        """
+        @param send: send(target, line), called on the reactor thread
+        @param budget: budget(target), the most bytes of text one line to
+            <target> may carry; None if max_bytes always fits
+        """
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.clock = clock
+        self.tokens = float(burst)
+        self.last = clock.seconds()
+        # per priority: target -> deque of (queued at, line), in turn order
+        self.queues = [OrderedDict(), OrderedDict()]
+        self.delayed = None
+        self.sent = 0
+        self.waits = deque(maxlen=1000)     # recent queue latencies
+        QUEUES.add(self)
+
+
+    @classmethod
+    def fromConfig(cls, send, c, budget=None):
+        from core.config import option
+        return cls(send,
+                   rate=option(c, 'outbound', 'rate', 1.0),
+                   burst=option(c, 'outbound', 'burst', 5),
+                   max_bytes=option(c, 'outbound', 'max_bytes', 400),
+                   budget=budget)
+
+
+    def put(self, target, message, bulk=False, merge=False):
+        """ Queue <message> (possibly several lines) for <target> """
+        now = self.clock.seconds()
+        queue = self.queues[BULK if bulk else INTERACTIVE]
+        pending = queue.get(target)
+        if pending is None:
+            pending = queue[target] = deque()
+        max_bytes = self.max_bytes
+        if self.budget is not None:
+            max_bytes = min(max_bytes, self.budget(target))
+        for line in lines(message, max_bytes, merge):
+            pending.append((now, line))
+        if not pending:
+            del queue[target]
+        self.pump()
+
+
+    def depth(self):
+        """ Lines waiting to be sent """
+        return sum(len(p) for q in self.queues for p in q.itervalues())
+
+
+    def pump(self):
+        """ Send as many lines as the bucket allows, then wait for tokens """
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        while self.tokens >= 1:
+            item = self._next()
+            if item is None:
+                break
+            target, queued, line = item
+            self.tokens -= 1
+            self.sent += 1
+            self.waits.append(now - queued)
+            SENT.inc()
+            WAIT_SECONDS.observe(now - queued)
+            self.send(target, line)
+        if self.delayed is None and self.depth():
+            wait = (1 - self.tokens) / self.rate
+            self.delayed = self.clock.callLater(wait, self._wake)
+
+
+    def _wake(self):
+        self.delayed = None
+        self.pump()
+
+
+    def _next(self):
+        for queue in self.queues:
+            if queue:
+                target, pending = queue.popitem(last=False)
+                queued, line = pending.popleft()
+                if pending:
+                    queue[target] = pending     # back of the line
+                return target, queued, line
+        return None
+
+
+    def stop(self):
+        """ Drop everything queued, e.g. when the connection is lost """
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+        for queue in self.queues:
+            queue.clear()
+
+
+    def latency(self):
+        """ (p50, p99, max) seconds lines recently waited in the queue """
+        if not self.waits:
+            return 0.0, 0.0, 0.0
+        waits = sorted(self.waits)
+        return (waits[len(waits) / 2], waits[min(len(waits) - 1, len(waits) * 99 / 100)],
+                waits[-1])
@@ -0,0 +1,177 @@
+"""
+On-demand profiling of the running bot, for the admin `profile` command.
+
+CpuProfiler samples the stack of the reactor thread from a profiling timer
+(ITIMER_PROF, so only time spent on the CPU counts) and tallies how often
+each function is running and how often it is anywhere on the stack.  A
+sample costs one walk up the stack, cheap enough to leave on for minutes.
+Results are saved as collapsed stacks ("outer;inner;leaf count"), the input
+of flamegraph.pl.
+
+Python 2 has no tracemalloc, so MemoryProfiler snapshots the number and
+size of the live objects of every type the garbage collector knows about
+and reports which types grew between start and stop.  Snapshots walk every
+object, so they are taken on the thread pool.
+"""
+import gc
+import os
+import signal
+import sys
+import time
+import types
+
+from twisted.internet import threads
+
+
+def label(code):
+    return '%s:%d(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno,
+                          code.co_name)
+
+
+
+class CpuProfiler(object):
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}        # tuple of code objects, outermost first -> samples
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+        self.previous = None
+
+
+    @classmethod
+    def fromConfig(cls, c):
+        from core.config import option
+        return cls(option(c, 'profile', 'interval', 0.005))
+
+
+    @property
+    def running(self):
+        return self.started is not None
+
+
+    def start(self):
+        """ Start sampling afresh; False if already running """
+        if self.running:
+            return False
+        self.stacks = {}
+        self.samples = 0
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        # restart system calls the timer interrupts instead of failing them
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.started = time.time()
+        return True
+
+
+    def stop(self):
+        """ Stop sampling; False if not running """
+        if not self.running:
+            return False
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous or signal.SIG_DFL)
+        self.elapsed = time.time() - self.started
+        self.started = None
+        return True
+
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+
+    def top(self, n=10):
+        """ The <n> busiest functions as (label, own samples, total samples) """
+        own = {}
+        total = {}
+        for stack, count in self.stacks.iteritems():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for code in set(stack):
+                total[code] = total.get(code, 0) + count
+        busiest = sorted(own, key=lambda code: -own[code])[:n]
+        return [(label(code), own[code], total[code]) for code in busiest]
+
+
+    def save(self, path, n=10):
+        """ Write the samples to <path> as collapsed stacks; returns top(n) """
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.iteritems(), key=lambda i: -i[1]):
+                f.write('%s %d\n' % (';'.join(label(code) for code in stack), count))
+        return self.top(n)
+
+
+
+def typeName(t):
+    return '%s.%s' % (getattr(t, '__module__', '?'), t.__name__)
+
+
+def snapshot():
+    """ {type name: (live objects, bytes)} of everything the gc tracks """
+    counts = {}
+    sizes = {}
+    for o in gc.get_objects():
+        t = type(o)
+        if t is types.InstanceType:
+            t = o.__class__
+        counts[t] = counts.get(t, 0) + 1
+        sizes[t] = sizes.get(t, 0) + sys.getsizeof(o, 0)
+    return dict((typeName(t), (counts[t], sizes[t])) for t in counts)
+
+
+
+class MemoryProfiler(object):
+
+    def __init__(self):
+        self.baseline = None
+
+
+    @property
+    def running(self):
+        return self.baseline is not None
+
+
+    def start(self):
+        """ A Deferred firing once the baseline is taken; None if running """
+        if self.running:
+            return None
+        self.baseline = {}
+        d = threads.deferToThread(snapshot)
+        d.addCallback(self._started)
+        return d
+
+
+    def _started(self, baseline):
+        if self.baseline is not None:
+            self.baseline = baseline
+        return len(baseline)
+
+
+    def stop(self, path, n=10):
+        """
+        A Deferred firing with the <n> types that grew most since start(),
+        as (type, objects now, objects added, bytes added), after writing
+        all of them to <path>; None if not running.
+        """
+        if not self.running:
+            return None
+        baseline, self.baseline = self.baseline, None
+        return threads.deferToThread(self._save, baseline, path, n)
+
+
+    def _save(self, baseline, path, n):
+        growth = []
+        for name, (count, size) in snapshot().iteritems():
+            oldCount, oldSize = baseline.get(name, (0, 0))
+            growth.append((name, count, count - oldCount, size - oldSize))
+        growth.sort(key=lambda g: (-g[3], -g[2]))
+        with open(path, 'w') as f:
+            f.write('%-60s %10s %10s %12s\n' % ('type', 'objects', 'added', 'bytes added'))
+            for g in growth:
+                f.write('%-60s %10d %+10d %+12d\n' % g)
+        return growth[:n]
@@ -0,0 +1,84 @@
+"""
+A local reservoir of quotes for the `quote` command.
+
+The pool is filled in the background from reddit, one listing page at a
+time, following reddit's `after` cursor to page deeper on every refill.
+Quotes are handed out in random order and never repeated until every quote
+collected so far has been used, at which point the pool starts a new cycle.
+"""
+import random
+
+from twisted.internet import task
+from twisted.python import log
+
+
+class QuotePool(object):
+
+    def __init__(self, fetch, interval=1800, low_water=20):
+        """
+        @param fetch: fetch(after), a Deferred firing with (titles, next cursor)
+        @param interval: seconds between scheduled refills
+        @param low_water: refill early when fewer quotes than this are left
+        """
+        self.fetch = fetch
+        self.interval = interval
+        self.low_water = low_water
+        self.unused = []
+        self.seen = set()       # quotes already queued in this cycle
+        self.after = None
+        self.refilling = False
+        self.loop = task.LoopingCall(self.refill)
+
+
+    @classmethod
+    def fromConfig(cls, c, fetch):
+        from core.config import option
+        return cls(fetch,
+                   interval=option(c, 'quotes', 'interval', 1800.0),
+                   low_water=option(c, 'quotes', 'low_water', 20))
+
+
+    def start(self):
+        if not self.loop.running:
+            self.loop.start(self.interval, now=True)
+
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+
+    def next(self):
+        """ A quote not handed out in this cycle, or None if the pool is dry """
+        if not self.unused:
+            # everything collected so far has been used: start over
+            self.seen.clear()
+            self.refill()
+            return None
+        quote = self.unused.pop()
+        if len(self.unused) < self.low_water:
+            self.refill()
+        return quote
+
+
+    def refill(self):
+        if self.refilling:
+            return
+        self.refilling = True
+        d = self.fetch(self.after)
+        d.addCallback(self._add)
+        d.addErrback(log.err)
+        d.addBoth(self._done)
+
+
+    def _add(self, page):
+        titles, self.after = page
+        fresh = [t for t in titles if t not in self.seen]
+        self.seen.update(fresh)
+        random.shuffle(fresh)
+        # older quotes are popped from the end first
+        self.unused[:0] = fresh
+
+
+    def _done(self, _):
+        self.refilling = False
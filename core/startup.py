@@ -0,0 +1,45 @@
+"""
+Where the time from process start to the first channel join goes.
+
+ircbot.py creates the StartupReport before anything else and marks each
+phase (imports, config, loading state, connecting, signing on, joining) as
+it ends; the report is logged once the first channel is joined.  The
+background warm-up after signing on is timed per module the same way.
+"""
+import time
+
+
+class StartupReport(object):
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.started = self.last = clock()
+        self.phases = []        # (phase, seconds)
+        self.finished = False
+
+
+    def mark(self, phase):
+        """ Note that <phase> just ended; ignored once the report is done """
+        if self.finished:
+            return
+        now = self.clock()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+
+    def finish(self, phase):
+        """ Mark the last phase; True the first time only """
+        if self.finished:
+            return False
+        self.mark(phase)
+        self.finished = True
+        return True
+
+
+    def total(self):
+        return self.last - self.started
+
+
+    def __str__(self):
+        return 'startup %.2fs: %s' % (self.total(), ', '.join(
+                '%s %.2fs' % (phase, seconds) for phase, seconds in self.phases))
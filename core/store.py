@@ -0,0 +1,167 @@
+"""
+Write-behind persistence for the bot's JSON files.
+
+A JsonStore keeps its document in memory.  Callers change store.data and
+call markDirty(); the store coalesces those changes and writes a snapshot
+once `delay` seconds have passed or `max_dirty` changes have piled up,
+whichever comes first.  Writes go to a temporary file in the same directory
+which is then renamed over the old one, on the reactor thread pool, so a
+crash can never leave a truncated file behind.
+
+Next to every JSON file the store keeps a binary snapshot (marshal, much
+faster to load than JSON) stamped with the size and mtime of the JSON file
+it matches.  Startup loads the snapshot when the stamp still matches, so
+editing the JSON by hand is always honoured.  The document itself is only
+loaded when store.data is first used.
+
+A store can also write a document it does not hold: with `source`, every
+snapshot is whatever source() returns, a fresh copy that is then encoded on
+the thread pool rather than the reactor, and store.data is never loaded.
+"""
+import json
+import marshal
+import os
+import tempfile
+import threading
+import time
+
+from twisted.internet import reactor, threads
+from twisted.python import log
+
+from core import metrics
+
+
+FLUSH_SECONDS = metrics.histogram('persist_flush_seconds',
+                                  'Time to write persisted state to disk', ('store', ))
+
+
+def atomicWrite(path, data):
+    """ Replace the file at path with data, all or nothing """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+class JsonStore(object):
+
+    def __init__(self, path, delay=5.0, max_dirty=100, source=None):
+        self.path = path
+        self.source = source
+        self.snapshotPath = path + '.marshal'
+        self.delay = delay
+        self.max_dirty = max_dirty
+        self._data = None
+        self.dirty = 0
+        self.generation = 0     # bumped for every snapshot taken
+        self.written = 0        # generation currently on disk
+        self.lock = threading.Lock()
+        self.delayed = None
+        self.writing = None
+
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.load()
+        return self._data
+
+
+    def load(self):
+        """ Read the document, or start empty if it is missing or broken """
+        try:
+            stamp = self._stamp()
+        except OSError:
+            return {}
+        try:
+            with open(self.snapshotPath, 'rb') as f:
+                if marshal.load(f) == stamp:
+                    return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+        try:
+            self._saveSnapshot(stamp, marshal.dumps(data))
+        except (IOError, OSError, ValueError):
+            pass
+        return data
+
+
+    def _stamp(self):
+        st = os.stat(self.path)
+        return (st.st_size, st.st_mtime)
+
+
+    def _saveSnapshot(self, stamp, dumped):
+        atomicWrite(self.snapshotPath, marshal.dumps(stamp) + dumped)
+
+
+    def markDirty(self, changes=1):
+        """ Note that data changed; it will be written soon """
+        self.dirty += changes
+        if self.dirty >= self.max_dirty:
+            self.flush()
+        elif self.delayed is None:
+            self.delayed = reactor.callLater(self.delay, self.flush)
+
+
+    def flush(self):
+        """ Write the current snapshot in the background """
+        if self.delayed is not None:
+            if self.delayed.active():
+                self.delayed.cancel()
+            self.delayed = None
+        if not self.dirty or self.writing is not None:
+            # a write in progress reschedules itself if more changes arrive
+            return
+        self.writing = threads.deferToThread(self._write, *self._snapshot())
+        self.writing.addErrback(log.err)
+        self.writing.addBoth(self._written)
+
+
+    def flushNow(self):
+        """ Write synchronously, for connectionLost and shutdown """
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+        if self.dirty:
+            self._write(*self._snapshot())
+
+
+    def _snapshot(self):
+        self.dirty = 0
+        self.generation += 1
+        if self.source is not None:
+            return self.source(), None, self.generation
+        return json.dumps(self.data), marshal.dumps(self.data), self.generation
+
+
+    def _write(self, snapshot, dumped, generation):
+        if dumped is None:
+            # a document from source(), ours alone, so encode it here
+            snapshot, dumped = json.dumps(snapshot), marshal.dumps(snapshot)
+        with self.lock:
+            # never let an older background snapshot replace a newer one
+            if generation > self.written:
+                start = time.time()
+                atomicWrite(self.path, snapshot)
+                self._saveSnapshot(self._stamp(), dumped)
+                self.written = generation
+                FLUSH_SECONDS.observe(time.time() - start, os.path.basename(self.path))
+
+
+    def _written(self, _):
+        self.writing = None
+        if self.dirty and self.delayed is None:
+            self.delayed = reactor.callLater(self.delay, self.flush)
@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+"""
+Passive triggers: handlers for channel lines that are not addressed to the
+bot, like `nick++`.
+
+Handlers are LogBot methods marked with the @trigger decorator:
+
+    @trigger(r'\+\+')
+    def award(self, user, channel, msg): ...
+
+All trigger patterns are compiled once into a single alternation, so every
+line is scanned once no matter how many triggers exist.  Handlers run in the
+order they are defined, for the triggers that matched, until one returns
+True.  Before the line is even decoded, a byte-level pattern built from the
+same triggers rules out the (common) lines that cannot match anything.
+"""
+import re
+
+from core.commands import marked
+
+
+def trigger(pattern, prefilter=None):
+    """
+    Mark a method as the handler for lines matching <pattern> (unicode,
+    matched case-insensitively).  <prefilter> is the same condition on the
+    raw UTF-8 bytes of the line; it defaults to the UTF-8 encoded pattern,
+    which only works for patterns without character classes outside ASCII.
+    """
+    def decorate(f):
+        f.trigger = Trigger(pattern, prefilter, f)
+        return f
+    return decorate
+
+
+
+class Trigger(object):
+
+    def __init__(self, pattern, prefilter, handler):
+        if isinstance(pattern, str):
+            pattern = pattern.decode('utf-8')
+        if prefilter is None:
+            prefilter = pattern.encode('utf-8')
+        self.pattern = pattern
+        self.prefilter = prefilter
+        self.handler = handler
+
+
+
+class TriggerSet(object):
+
+    def __init__(self, cls):
+        """ Compile the @trigger handlers of class <cls> into one matcher """
+        self.triggers = marked(cls, 'trigger')
+        self.groups = ['t%d' % i for i in range(len(self.triggers))]
+        alternatives = [u'(?P<%s>%s)' % (g, t.pattern)
+                        for g, t in zip(self.groups, self.triggers)]
+        self.regex = re.compile(u'|'.join(alternatives) or u'(?!)', re.I | re.U)
+        self.prefilter = re.compile(
+                '|'.join(['(?:%s)' % t.prefilter for t in self.triggers]) or '(?!)',
+                re.I)
+
+
+    def mayMatch(self, raw):
+        """ Could the undecoded line <raw> match any trigger? """
+        return self.prefilter.search(raw) is not None
+
+
+    def matching(self, msg):
+        """ Handlers of the triggers matching unicode line <msg>, in order """
+        hit = set()
+        for m in self.regex.finditer(msg):
+            hit.add(m.lastgroup)
+        return [t.handler for g, t in zip(self.groups, self.triggers) if g in hit]
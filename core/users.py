@@ -0,0 +1,263 @@
+"""
+The table of every nick the bot knows, with points and when it last saw them.
+
+A nick is known by its RFC 1459 case-folded form (core.nicks.fold), so
+"Bob" and "bob" are the same user; the spelling first seen is the one
+shown.  Nicks are kept as UTF-8 bytes, and the folded key and the shown
+spelling are one string whenever they are equal, as they mostly are.
+Each user is a slot in parallel arrays of points and last-seen times
+instead of a dict of its own.
+
+Users with no points who have not been seen for `idle_days` are moved to
+cold storage, a tab separated file of nick and last-seen time, by a daily
+sweep; they lose nothing but their last-seen time, and come back as new
+users when they next join or speak.  Their slots are reused.
+
+Speaking counts as being seen too.  heard() is called for every line, so it
+only remembers the nick; once a minute the nicks heard are noted like a
+join, and last-seen times are saved when they moved by more than
+`resolution` seconds, so chatter does not keep rewriting the file.
+
+The table is persisted in files/user_info.json as parallel lists,
+
+    {"version": 2, "nicks": [...], "points": [...], "seen": [...]}
+
+and a file in the old format is converted when loaded.
+"""
+import sys
+from array import array
+from itertools import izip, repeat
+
+from twisted.internet import reactor, task, threads
+from twisted.python import log
+
+from core.nicks import fold, text, RFC1459_BYTES
+from core.store import JsonStore
+
+
+class UserTable(object):
+
+    def __init__(self, path, delay=5.0, max_dirty=100, idle_days=90.0, cold=None,
+                 resolution=3600, clock=reactor):
+        """
+        @param path: the JSON file the table is kept in
+        @param cold: the file inactive users are moved to; None keeps them
+        """
+        self.store = JsonStore(path, delay, max_dirty, source=self.document)
+        self.idle = idle_days * 86400
+        self.cold = cold
+        self.resolution = resolution
+        self.clock = clock
+        self.index = {}             # folded nick -> slot
+        self.names = []             # slot -> nick as first seen, None if free
+        self.points = array('i')    # slot -> points
+        self.seen = array('i')      # slot -> last seen, in seconds since the epoch
+        self.free = []              # slots of users moved to cold storage
+        self.heardNicks = set()     # nicks that spoke since the last noteHeard()
+        self.sweeper = task.LoopingCall(self.sweep)
+        self.sweeper.clock = clock
+        self.noter = task.LoopingCall(self.noteHeard)
+        self.noter.clock = clock
+
+
+    @classmethod
+    def fromConfig(cls, c, path):
+        from core.config import option
+        cold = option(c, 'users', 'cold', 'files/users.cold')
+        return cls(path,
+                   delay=option(c, 'persist', 'delay', 5.0),
+                   max_dirty=option(c, 'persist', 'max_dirty', 100),
+                   idle_days=option(c, 'users', 'idle_days', 90.0),
+                   cold=cold or None,
+                   resolution=option(c, 'users', 'seen_resolution', 3600))
+
+
+    def load(self):
+        """ Read the table from disk, converting the old format """
+        data = self.store.load()
+        if data.get('version') == 2:
+            # in bulk, which is several times faster than _add() per user;
+            # the marshal snapshot has bytes already, JSON has unicode
+            names = data['nicks']
+            if names and isinstance(names[0], unicode):
+                names = [n.encode('utf-8') for n in names]
+            keys = map(str.translate, names, repeat(RFC1459_BYTES, len(names)))
+            self.names = [key if key == nick else nick for key, nick in izip(keys, names)]
+            self.index = dict(izip(keys, xrange(len(keys))))
+            self.points = array('i', data['points'])
+            self.seen = array('i', data['seen'])
+            return
+        # {nick: {'points': N}}; nicks differing only in case are merged
+        now = int(self.clock.seconds())
+        for nick, info in data.iteritems():
+            slot = self.slot(nick)
+            if slot is None:
+                self._add(nick, info.get('points', 0), now)
+            else:
+                self.points[slot] += info.get('points', 0)
+        if data:
+            self.store.markDirty()
+
+
+    def document(self):
+        """ A copy of the table to persist """
+        used = [i for i, name in enumerate(self.names) if name is not None]
+        if len(used) == len(self.names):
+            return {'version': 2, 'nicks': list(self.names),
+                    'points': self.points.tolist(), 'seen': self.seen.tolist()}
+        return {'version': 2, 'nicks': [self.names[i] for i in used],
+                'points': [self.points[i] for i in used],
+                'seen': [self.seen[i] for i in used]}
+
+
+    def _add(self, nick, points, seen):
+        if isinstance(nick, unicode):
+            nick = nick.encode('utf-8')
+        key = fold(nick)
+        if nick == key:
+            nick = key
+        if self.free:
+            slot = self.free.pop()
+            self.names[slot] = nick
+            self.points[slot] = points
+            self.seen[slot] = seen
+        else:
+            slot = len(self.names)
+            self.names.append(nick)
+            self.points.append(points)
+            self.seen.append(seen)
+        self.index[key] = slot
+        return slot
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __contains__(self, nick):
+        return fold(nick) in self.index
+
+
+    def slot(self, nick):
+        return self.index.get(fold(nick))
+
+
+    def name(self, nick):
+        """ How <nick> is shown, as unicode: the spelling first seen """
+        slot = self.slot(nick)
+        return text(nick) if slot is None else text(self.names[slot])
+
+
+    def get(self, nick):
+        """ The points of <nick>, 0 for unknown nicks """
+        slot = self.slot(nick)
+        return 0 if slot is None else self.points[slot]
+
+
+    def scores(self):
+        """ (nick, points) of everyone with points, nicks as unicode """
+        for slot, points in enumerate(self.points):
+            if points and self.names[slot] is not None:
+                yield text(self.names[slot]), points
+
+
+    def see(self, nick):
+        """ Note that <nick> is here; True if it is a new user """
+        now = int(self.clock.seconds())
+        slot = self.slot(nick)
+        if slot is not None:
+            if now - self.seen[slot] > self.resolution:
+                self.store.markDirty()
+            self.seen[slot] = now
+            return False
+        self._add(nick, 0, now)
+        self.store.markDirty()
+        return True
+
+
+    def heard(self, nick):
+        """ Note that <nick> spoke, cheaply; see() follows in noteHeard() """
+        self.heardNicks.add(nick)
+
+
+    def noteHeard(self):
+        heard, self.heardNicks = self.heardNicks, set()
+        for nick in heard:
+            self.see(nick)
+
+
+    def award(self, nick, by=1):
+        """ Give <nick> a point; returns (shown nick, points now) """
+        slot = self.slot(nick)
+        if slot is None:
+            slot = self._add(nick, 0, int(self.clock.seconds()))
+        self.points[slot] += by
+        self.store.markDirty()
+        return text(self.names[slot]), self.points[slot]
+
+
+    def start(self):
+        if not self.noter.running:
+            self.noter.start(60, now=False)
+        if self.cold is not None and not self.sweeper.running:
+            self.sweeper.start(86400, now=False)
+
+
+    def stop(self):
+        if self.noter.running:
+            self.noter.stop()
+        self.noteHeard()
+        if self.sweeper.running:
+            self.sweeper.stop()
+
+
+    def sweep(self):
+        """
+        Move users without points not seen for idle_days to cold storage,
+        a slice of the table at a time so the reactor keeps serving; fires
+        with how many were moved.
+        """
+        self.noteHeard()
+        moved = []
+        d = task.coiterate(self._sweep(moved))
+        d.addCallback(lambda _: self._moved(moved))
+        return d
+
+
+    def _sweep(self, moved, chunk=10000):
+        cutoff = self.clock.seconds() - self.idle
+        names, points, seen = self.names, self.points, self.seen
+        for start in xrange(0, len(names), chunk):
+            for slot in xrange(start, min(start + chunk, len(names))):
+                if not points[slot] and seen[slot] < cutoff and names[slot] is not None:
+                    nick = names[slot]
+                    moved.append('%s\t%d\n' % (nick, seen[slot]))
+                    del self.index[fold(nick)]
+                    names[slot] = None
+                    self.free.append(slot)
+            yield None
+
+
+    def _moved(self, moved):
+        if moved:
+            self.store.markDirty(len(moved))
+            threads.deferToThread(self._freeze, ''.join(moved)).addErrback(log.err)
+        return len(moved)
+
+
+    def _freeze(self, lines):
+        with open(self.cold, 'a') as f:
+            f.write(lines)
+
+
+    def memory(self):
+        """ {'users', 'free', 'bytes'}: an estimate of what the table takes """
+        size = (sys.getsizeof(self.index) + sys.getsizeof(self.names) +
+                self.points.buffer_info()[1] * self.points.itemsize +
+                self.seen.buffer_info()[1] * self.seen.itemsize +
+                sys.getsizeof(self.free))
+        for key, slot in self.index.iteritems():
+            size += sys.getsizeof(key)
+            if self.names[slot] is not key:
+                size += sys.getsizeof(self.names[slot])
+        return {'users': len(self.index), 'free': len(self.free), 'bytes': size}
@@ -5,45 +5,60 @@ ircbot derived from https://github.com/sambev/ircbot
 Edit config.cfg
 """
 
+# time the startup from here on (see core.startup)
+from core.startup import StartupReport
+startup = StartupReport()
 
 # twisted imports
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol
+from twisted.internet import reactor, protocol, threads
 from twisted.python import log
 
 # system imports
 import time
+import os
 import sys
 import ConfigParser
-import json
 import traceback
 import re
+import fnmatch
+
+from apis import httpclient, procpool
+from core import metrics
+from core.backends import Backends, BackendDown, BACKEND_SECONDS, BACKEND_ERRORS, \
+        RETRIES, REJECTED
+from core.cache import ResponseCache
+from core.commands import command
+from core.history import History
+from core.config import option
+from core.karma import KarmaJournal, WINDOWS
+from core.leaderboard import Leaderboard
+from core.logger import MessageLogger
+from core.mailbox import Mailbox, MailboxFull
+from core.menu import DailyMenu
+from core.networks import networks
+from core.nicks import text
+from core.outbound import OutboundQueue
+from core.profiler import CpuProfiler, MemoryProfiler
+from core.quotes import QuotePool
+from core.store import JsonStore
+from core.triggers import trigger, TriggerSet
+from core.users import UserTable
 
 
 MESSAGES_JSON = 'files/messages.json'
 USERINFO_JSON = 'files/user_info.json'
 
+AWARD = re.compile(r'([^ :+]+)[ :]*[+][+]', re.U)
+ADMIT_NOBODY = re.compile(u'承認.+沒有人', re.U)
 
-class MessageLogger:
-    """
-    An independent logger class (because separation of application
-    and protocol logic is a good thing).
-    """
-    def __init__(self, file):
-        self.file = file
-
-
-    def log(self, message):
-        """Write a message to the file."""
-        timestamp = time.strftime("[%H:%M:%S]", time.localtime(time.time()))
-        if message.strip() == '': return
-        self.file.write('%s %s\n' % (timestamp, message))
-        self.file.flush()
-
-
-    def close(self):
-        self.file.close()
-
+LINES = metrics.counter('irc_lines_total',
+                        'Lines received, by whether any handler looked at them',
+                        ('kind', ))
+HANDLER_SECONDS = metrics.histogram('handler_seconds',
+                                    'Time spent in trigger and command handlers', ('handler', ))
+HANDLER_ERRORS = metrics.counter('handler_errors_total', 'Handler calls that raised',
+                                 ('handler', ))
 
 
 class LogBot(irc.IRCClient):
@@ -51,170 +66,223 @@ class LogBot(irc.IRCClient):
    
     # the nickname might have problems with uniquness when connecting to freenode.net 
     nickname = "AL"
-    stored_messages = {}
-    user_info = {}
 
 
-    def __init__(self, nickname):
-        self.stored_messages = self.getMessages()
-        self.user_info = self.getUserInfo()
+    def __init__(self, nickname, users):
+        self.users = users
         self.nickname = nickname
 
-    
-    def getMessages(self):
-        """ Get my persisted messages from the message.json file"""
-        with open(MESSAGES_JSON, 'r') as f:
-            try:
-                messages = json.loads(f.read())
-                return messages
-            except:
-                return {}
+
+    def logError(self, channel):
+        """ Log an error to STDOUT, the logs, and chat """
+        print traceback.format_exc() 
+        self.loggerFor(channel).log("Traceback Error:\n%s" % traceback.format_exc())
+        # self.msg(channel, 'There was an Error in your request, check the logs')
 
 
-    def saveMessages(self):
-        """ Presist my stored messages by writing to a file"""
-        with open(MESSAGES_JSON, 'w') as f:
-            f.write(json.dumps(self.stored_messages))
+    def logFailure(self, failure, channel):
+        """ Log a failed Deferred the same way logError logs an exception """
+        print failure.getTraceback()
+        self.loggerFor(channel).log("Traceback Error:\n%s" % failure.getTraceback())
 
 
-    def getUserInfo(self):
-        """ Get information about my users """
-        with open(USERINFO_JSON, 'r') as f:
-            try:
-                userinfo = json.loads(f.read())
-                return userinfo
-            except:
-                return {}
+    def defer(self, channel, reply, backend, f, *args):
+        """
+        Run the blocking call f(*args) on the reactor thread pool and pass its
+        result to reply() back on the reactor thread, so a slow backend does
+        not stop the bot from answering PINGs or other commands.  <backend>
+        names the deadline, retries and circuit breaker (core.backends).
+        """
+        d = self.services.backends.call(backend, f, *args)
+        d.addCallback(reply)
+        d.addErrback(self.backendDown, channel)
+        d.addErrback(self.logFailure, channel)
+        return d
+
+
+    def cached(self, channel, reply, backend, f, *args, **kwargs):
+        """ Like defer(), but answered from the response cache when possible """
+        d = self.services.cache.lookup(backend, f, *args, **kwargs)
+        d.addCallback(reply)
+        d.addErrback(self.backendDown, channel)
+        d.addErrback(self.logFailure, channel)
+        return d
+
+
+    def backendDown(self, failure, channel):
+        """ The canned reply while a backend's circuit breaker is open """
+        failure.trap(BackendDown)
+        self.msg(channel, "Sorry, {0} isn't answering right now; try again in a minute".format(
+                failure.value.args[0]))
+
+
+    def isAdmin(self, prefix):
+        """ Does nick!user@host match one of the configured owners? """
+        prefix = prefix.lower()
+        for pattern in self.services.owners:
+            if fnmatch.fnmatchcase(prefix, pattern.lower()):
+                return True
+        return False
 
 
-    def logError(self, channel):
-        """ Log an error to STDOUT, the logs, and chat """
-        print traceback.format_exc() 
-        self.logger.log("Traceback Error:\n%s" % traceback.format_exc())
-        # self.msg(channel, 'There was an Error in your request, check the logs')
+    def loggerFor(self, channel):
+        """ The logger for <channel>; private chat goes to the network's log """
+        settings = self.factory.network.channel(channel)
+        if settings is None:
+            return self.logger
+        return self.services.logger(settings.logfile)
+
 
+    def commandsFor(self, channel):
+        """ The commands enabled on <channel> """
+        settings = self.factory.network.channel(channel)
+        if settings is None:
+            return self.factory.network.commands
+        return settings.commands
 
-    def saveUserInfo(self):
-        """ Save my user data """
-        with open(USERINFO_JSON, 'w') as f:
-            f.write(json.dumps(self.user_info))
+
+    def msg(self, user, message, length=None, bulk=False, merge=False):
+        """
+        Queue a message for the outbound scheduler (see core.outbound).
+        Bulk output waits behind interactive replies; merge joins short
+        lines of the message to save lines.
+        """
+        self.outbound.put(user, message, bulk, merge)
+
+
+    def _sendMessage(self, target, line):
+        # the queue has split the line already; IRCClient.msg would split
+        # it again, to its own length and in the middle of characters
+        self.sendLine('PRIVMSG %s :%s' % (target, line))
+
+
+    def _lineBudget(self, target):
+        """ The bytes of text a PRIVMSG to <target> can carry """
+        prefix = 'PRIVMSG %s :' % (target, )
+        return self._safeMaximumLineLength(prefix) - len(prefix) - 2
 
 
     def connectionMade(self):
+        self.outbound = OutboundQueue.fromConfig(self._sendMessage,
+                                                 self.services.config,
+                                                 budget=self._lineBudget)
         irc.IRCClient.connectionMade(self)
-        self.logger = MessageLogger(open(self.factory.filename, "a"))
+        self.services.startup.mark('connect')
+        self.logger = self.services.logger(self.factory.network.logfile)
         self.logger.log("[connected at %s]" % 
                         time.asctime(time.localtime(time.time())))
-        self.join(self.factory.channel)
 
 
     def connectionLost(self, reason):
         irc.IRCClient.connectionLost(self, reason)
+        self.outbound.stop()
         self.logger.log("[disconnected at %s]" % 
                         time.asctime(time.localtime(time.time())))
-        self.logger.close()
+        # the loggers are shared, so write out what is queued but keep them open
+        for logger in self.loggers():
+            logger.flush()
+        self.services.flush()
+
+
+    def loggers(self):
+        """ The open loggers of this network and its channels """
+        paths = set(c.logfile for c in self.factory.network.channels.itervalues())
+        return set([self.logger] + [self.services.loggers[path] for path in paths
+                                    if path in self.services.loggers])
 
     # commands
 
     def remember(self, user, channel):
         try:
-            if user not in self.user_info:
-                self.user_info[user] = { 'points': 0 }
-                self.saveUserInfo()
-                self.logger.log("[Add %s to user_info]" % user)
+            if self.users.see(user):
+                self.loggerFor(channel).log("[Add %s to user_info]" % user)
             else:
-                self.logger.log("User %s logged in.  Points = %d" %
-                        (user, self.user_info[user]['points']))
+                self.loggerFor(channel).log("User %s logged in.  Points = %d" %
+                        (user, self.users.get(user)))
         except Exception as e:
             self.logError(channel)
 
+    @trigger(r'\+\+')
     def award(self, user, channel, msg):
         "Input: ipa++ 或 ipa ++ 或 ipa: ++ 或 ipa:++"
-        if msg.find('++') == -1:
-            return False
-        aw = re.compile(r'([^ :+]+)[ :]*[+][+]')
-        for awardee in aw.findall(msg):
-            if awardee not in self.user_info:
-                self.user_info[awardee] = { 'points': 0 }
-            self.user_info[awardee]['points'] += 1
-            self.saveUserInfo()
-            sc = self.user_info[awardee]['points']
-            self.logger.log('{0} has {1} point(s)'. format(awardee, sc))
+        awardees = AWARD.findall(msg)
+        for awardee in awardees:
+            nick, sc = self.users.award(awardee)
+            self.services.leaderboard.set(nick, sc)
+            self.services.karma.record(user, awardee, channel)
+            self.loggerFor(channel).log(u'{0} has {1} point(s)'. format(awardee, sc))
         return True
 
 
+    @trigger(u'沒有人')
     def nobody_tw(self, user, channel, msg):
-        nb = re.compile(u'承認.+沒有人')
-        if nb.search(msg):
+        if ADMIT_NOBODY.search(msg):
             try:
                 user = msg.split(':')[0]
             except IndexError:
                 return True
         elif msg.find(u'有沒有人') > -1:
             return False
-        elif msg.find(u'沒有人') == -1:
-            return False
         if user == self.nickname:
             self.msg(channel, '你才是沒有人!')
         else:
-            self.msg(channel, '%s: 先承認你就是沒有人' % (user.encode('utf-8'),))
+            self.msg(channel, '%s: 先承認你就是沒有人' % (text(user).encode('utf-8'),))
         return True
 
 
+    @trigger(u'nobody')
     def nobody_en(self, user, channel, msg):
-        if msg.lower().find(u'nobody') == -1:
-            return False
         self.msg(channel, '%s is nobody!' % (user,))
         return True
 
 
-    def cafe(self, cmd, user, channel, msg):
-        from scrapers.cafescraper import scrapeCafe
-        if cmd != 'cafe':
-            return False
-        menu = scrapeCafe()
-        # make the menu all nice for chat purposes
-        for k, v in menu['stations'].items():
-            if v:
-                station = '{:.<{station_width}}'.format(k.encode('utf-8'), station_width=menu['station_max_width'] + 4)
-                item = '{:.>{item_width}}'.format(v['item'].encode('utf-8'), item_width=menu['item_max_width'])
-                self.msg(channel, '%s%s   %s' % (station, item, v['price'].encode('utf-8')))
-        return True
-
-
-    def hi(self, cmd, user, channel, msg):
-        if cmd not in [u'hi', u'salam', u'selam', u'哈囉', u'你好', u'merhaba']:
-            return False
+    @command('cafe', enabled=False, warm=('scrapers.cafescraper', None))
+    def cafe(self, user, channel, args):
+        def reply(menu):
+            # make the menu all nice for chat purposes
+            for k, v in menu['stations'].items():
+                if v:
+                    station = '{:.<{station_width}}'.format(k.encode('utf-8'), station_width=menu['station_max_width'] + 4)
+                    item = '{:.>{item_width}}'.format(v['item'].encode('utf-8'), item_width=menu['item_max_width'])
+                    self.msg(channel, '%s%s   %s' % (station, item, v['price'].encode('utf-8')),
+                             bulk=True)
+        d = self.services.menu.lookup()
+        d.addCallback(reply)
+        d.addErrback(self.backendDown, channel)
+        d.addErrback(self.logFailure, channel)
+
+
+    @command(u'hi', u'salam', u'selam', u'哈囉', u'你好', u'merhaba')
+    def hi(self, user, channel, args):
         self.msg(channel, 'Hi! 我是 ' + self.nickname)
-        return True
 
 
-    def quote(self, cmd, user, channel, msg):
-        "quote - 從 Reddit 隨機引用一句話"
+    @command('quote', help='quote - 從 Reddit 隨機引用一句話')
+    def quote(self, user, channel, args):
         from apis.reddit import getQuote
-        if cmd != u'quote':
-            return False
-        randomQuote = getQuote()
+        def reply(randomQuote):
+            if randomQuote is not None:
+                self.msg(channel, randomQuote.encode('utf-8'))
+            else:
+                self.msg(channel, 'Sorry.  I failed to get a quote.')
+        randomQuote = self.services.quotes.next()
         if randomQuote is not None:
-            self.msg(channel, randomQuote.encode('utf-8'))
+            reply(randomQuote)
         else:
-            self.msg(channel, 'Sorry.  I failed to get a quote.')
-        return True
+            self.defer(channel, reply, 'reddit', getQuote)
 
 
-    def weather(self, cmd, user, channel, msg):
+    @command('weather', enabled=False,
+             warm=('apis.weatherman', 'http://api.openweathermap.org/'))
+    def weather(self, user, channel, args):
         from apis.weatherman import currentWeather
-        if cmd != u'weather':
-            return False
-        parts = msg.split()
-        if len(parts) == 3 and  parts[2].isdigit() and len(parts[2]) == 5:
-            weather = currentWeather('', '', parts[2])
-        elif len(parts) >= 4:
-            state = parts.pop()
-            city = ' '.join(parts[2:])
-            weather = currentWeather(city, state)
+        if len(args) == 1 and args[0].isdigit() and len(args[0]) == 5:
+            args = ('', '', args[0])
+        elif len(args) >= 2:
+            args = (' '.join(args[:-1]), args[-1])
         else:
-            weather = currentWeather()
+            args = ()
+        def reply(weather):
             w_msg = 'The weather in {0} is {1}, {2} degrees, {3}% humdity.'.format(
                     weather['place'],
                     weather['status'],
@@ -222,192 +290,431 @@ class LogBot(irc.IRCClient):
                     weather['humidity']
                     )
             self.msg(channel, w_msg)
-            self.logger.log(w_msg)
-        return True
+            self.loggerFor(channel).log(w_msg)
+        self.cached(channel, reply, 'weather', currentWeather, *args)
 
 
-    def tell(self, cmd, user, channel, msg):
-        if cmd != u'tell':
-            return False
-        parts = msg.split()
-        target_user = parts[2]
-        tell_msg = '{0}, {1} said: {2}'.format(target_user, user, ' '.join(parts[3:]))
-        if target_user not in self.stored_messages:
-            self.stored_messages[target_user] = []
-        self.stored_messages[target_user].append(tell_msg)
-        self.saveMessages()
-        self.msg(channel, 'I will pass that along when {0} joins'.format(target_user))
-        return True
+    @command('tell', nargs=2, enabled=False)
+    def tell(self, user, channel, args):
+        target_user = args[0]
+        tell_msg = u'{0}, {1} said: {2}'.format(target_user, text(user), ' '.join(args[1:]))
+        try:
+            self.services.mailbox.send(text(user), target_user, tell_msg)
+        except MailboxFull as e:
+            self.msg(channel, u'Sorry, {0}'.format(e.args[0]).encode('utf-8'))
+            return
+        self.msg(channel, u'I will pass that along when {0} joins or speaks'.format(
+                target_user).encode('utf-8'))
 
 
-    def movie(self, cmd, user, channel, msg):
+    def deliver(self, user, channel):
+        """ Pass on the mail waiting for <user>, in one batch """
+        lines = self.services.mailbox.take(user)
+        if lines:
+            self.msg(channel, u'\n'.join(lines), bulk=True)
+            self.loggerFor(channel).log('[delivered %d message(s) to %s]' % (len(lines), user))
+
+
+    @command('movie', nargs=1, enabled=False,
+             warm=('apis.rottentomatoes', 'http://api.rottentomatoes.com/'))
+    def movie(self, user, channel, args):
         from apis.rottentomatoes import rottentomatoes
-        if cmd != u'movie':
-            return False
-        key = self.factory.rottentomatoes
+        key = self.services.rottentomatoes
         if key is None:
-            self.logger.log('Please set rottentomatoes key')
-            return False
-        movie = ' '.join(parts[2:])
-        movie_response = rottentomatoes(movie, key)
-        if movie_response:
-            answer = 'Critics Score: {0}\nAudience Score: {1}\n{2}'.format(
-                    movie_response['critics_score'],
-                    movie_response['audience_score'],
-                    movie_response['link'])
-            self.msg(channel, answer)
-        else:
-            answer = 'I can\'t find that movie'
-            self.msg(channel, answer)
-        return True
+            self.loggerFor(channel).log('Please set rottentomatoes key')
+            return
+        movie = ' '.join(args)
+        def reply(movie_response):
+            if movie_response:
+                answer = 'Critics Score: {0}\nAudience Score: {1}\n{2}'.format(
+                        movie_response['critics_score'],
+                        movie_response['audience_score'],
+                        movie_response['link'])
+                self.msg(channel, answer)
+            else:
+                answer = 'I can\'t find that movie'
+                self.msg(channel, answer)
+        self.cached(channel, reply, 'movie', rottentomatoes, movie, key)
 
 
-    def reddit(self, cmd, user, channel, msg):
-        "reddit <subreddit> [# of article] - 查詢 reddit"
+    @command('reddit', nargs=1, help='reddit <subreddit> [# of article] - 查詢 reddit',
+             warm=('apis.reddit', 'http://www.reddit.com/'))
+    def reddit(self, user, channel, args):
         from apis.reddit import getSubReddit
-        if cmd != u'reddit':
-            return False
-        parts = msg.split()
-        subreddit = parts[2]
+        subreddit = args[0]
         try:
-            count = int(parts[3])
-        except IndexError:
+            count = int(args[1])
+        except (IndexError, ValueError):
             count = 1
 
-        reddit_response = getSubReddit(subreddit, count)
-        if reddit_response:
-            answer = '{0}: {1} : {2}'.format(
-                    count,
-                    reddit_response['title'],
-                    reddit_response['url'])
-            self.msg(channel, answer.encode('utf-8'))
-        else:
-            answer = 'I can\'t find that on reddit'
-            self.msg(channel, answer)
-        return True
+        def reply(reddit_response):
+            if reddit_response:
+                answer = '{0}: {1} : {2}'.format(
+                        count,
+                        reddit_response['title'],
+                        reddit_response['url'])
+                self.msg(channel, answer.encode('utf-8'))
+            else:
+                answer = 'I can\'t find that on reddit'
+                self.msg(channel, answer)
+        self.cached(channel, reply, 'reddit', getSubReddit, subreddit, count)
 
 
-    def define(self, cmd, user, channel, msg):
+    @command('define', nargs=1, enabled=False,
+             warm=('apis.urbandic', 'http://api.urbandictionary.com/'))
+    def define(self, user, channel, args):
         from apis.urbandic import urbanDict
-        if cmd != u'define':
-            return False
-        question = ' '.join(parts[2:])
-        urban_response = urbanDict(question)
-        if urban_response:
-            answer = '{0}\nFor Example: {1}\n{2}'.format(
-                    urban_response['definition'], 
-                    urban_response['example'], 
-                    urban_response['permalink']) 
-            self.msg(channel, answer)
+        question = ' '.join(args)
+        def reply(urban_response):
+            if urban_response:
+                answer = '{0}\nFor Example: {1}\n{2}'.format(
+                        urban_response['definition'], 
+                        urban_response['example'], 
+                        urban_response['permalink']) 
+                self.msg(channel, answer)
+            else:
+                answer = 'I don\'t know'
+                self.msg(channel, answer)
+        self.cached(channel, reply, 'define', urbanDict, question)
+
+
+    @command('top10', help='top10 [day|week|month] - 按讚排行榜')
+    def top10(self, user, channel, args):
+        if args and args[0].lower() in WINDOWS:
+            tops = [(self.users.name(nick), points)
+                    for nick, points in self.services.karma.top(args[0].lower(), 10)]
         else:
-            answer = 'I don\'t know'
-            self.msg(channel, answer)
-        return True
+            tops = self.services.leaderboard.top(10)
+        self.msg(channel, ', '.join(['%s: %d' % v for v in tops]).encode('utf-8'))
 
 
-    def top10(self, cmd, user, channel, msg):
-        "top10 - 按讚排行榜"
-        from operator import itemgetter
-        if cmd != u'top10':
-            return False
-        tops = sorted(self.user_info.iteritems(), key=itemgetter(1), reverse = True)
-        self.msg(channel, ', '.join(['%s: %d' % (v[0], v[1]['points']) for v in tops[0:10]]).encode('utf-8'))
-        return True
+    @command('rank', help='rank [nick] - 排行榜名次')
+    def rank(self, user, channel, args):
+        nick = self.users.name(args[0] if args else user)
+        rank = self.services.leaderboard.rank(nick)
+        if rank is None:
+            self.msg(channel, '%s has no points yet' % (nick.encode('utf-8'), ))
+        else:
+            self.msg(channel, '%s is #%d of %d' % (nick.encode('utf-8'), rank,
+                    len(self.services.leaderboard)))
 
 
-    def moedict(self, cmd, user, channel, msg):
-        "moe <詞> - 查詢萌典"
-        from apis.moedict import quote
-        if cmd != u'moe':
-            return False
-        parts = msg.split()
-        self.msg(channel, quote(parts[2]))
-        return True
+    @command('around', help='around [nick] - 排行榜上前後的人')
+    def around(self, user, channel, args):
+        nick = self.users.name(args[0] if args else user)
+        places = self.services.leaderboard.around(nick)
+        if not places:
+            self.msg(channel, '%s has no points yet' % (nick.encode('utf-8'), ))
+        else:
+            self.msg(channel, ', '.join([u'#%d %s: %d' % v for v in places]).encode('utf-8'))
+
+
+    @command('karma', help='karma [nick] - 最近一天/週/月的讚與來源')
+    def karma(self, user, channel, args):
+        nick = self.users.name(args[0] if args else user)
+        total = self.users.get(nick)
+        recent = self.services.karma.points(nick)
+        givers = [self.users.name(e[1]) for e in reversed(self.services.karma.recent(nick))]
+        answer = u'{0}: {1} points ({2} today, {3} this week, {4} this month)'.format(
+                nick, total, recent['day'], recent['week'], recent['month'])
+        if givers:
+            answer += u', latest from ' + u', '.join(givers[:5])
+        self.msg(channel, answer.encode('utf-8'))
+
+
+    @command('moe', nargs=1, help='moe <詞> - 查詢萌典',
+             warm=('apis.moedict', 'https://www.moedict.tw/'))
+    def moedict(self, user, channel, args):
+        from apis.moedict import quote, FAILED
+        def reply(answer):
+            self.msg(channel, answer)
+        self.cached(channel, reply, 'moe', quote, args[0],
+                cacheable=lambda answer: answer != FAILED)
 
 
-    def song(self, cmd, user, channel, msg):
+    @command('song', nargs=1, enabled=False,
+             warm=('apis.lastfm', 'http://ws.audioscrobbler.com/'))
+    def song(self, user, channel, args):
         from apis.lastfm import getCurrentSong
-        if cmd != u'song':
-            return False
-        parts = msg.split()
-        user = parts[2]
-        song = getCurrentSong(user)
-        if song:
-            self.msg(channel, '{0} is listening to {1}'.format(user, song.encode('utf-8')))
-        return True
+        user = args[0]
+        def reply(song):
+            if song:
+                self.msg(channel, '{0} is listening to {1}'.format(user, song.encode('utf-8')))
+        self.defer(channel, reply, 'song', getCurrentSong, user)
 
 
-    def funslots(self, cmd, user, channel, msg):
-        "funslots - 網友 x 的繽紛樂"
+    @command('funslots', help='funslots - 網友 x 的繽紛樂', warm=('apis.funslots', None))
+    def funslots(self, user, channel, args):
         from apis.funslots import funslots
-        if cmd != u'funslots':
-            return False
         fun = funslots()
         self.msg(channel, fun)
-        return True
 
 
-    def wolfram(self, user, channel, msg):
-        from apis.wolfram import wolfram
-        key = self.factory.wolfram
-        if key is None:
-            return False
-        question = ' '.join(msg.split()[1:])
-        self.logger.log('Asking wolfram for "%s"' % (question, ))
-        w = wolfram(key)
-        result = w.search(question)
-        if result:
-            answer = result.get('Value', 
-                    result.get('Result',
-                    result.get('Definition',
-                    result.get('Statement',
-                    result.get('Current result',
-                    None)))))
-            if answer:
-                self.msg(channel, answer.encode('utf-8'))
-            else:
+    @command('wolfram', nargs=1, enabled=False,
+             warm=('apis.wolfram', 'http://api.wolframalpha.com/'))
+    def wolfram(self, user, channel, args):
+        w = self.services.wolfram
+        if w is None:
+            self.loggerFor(channel).log('Please set wolfram key')
+            return
+        question = ' '.join(args)
+        self.loggerFor(channel).log('Asking wolfram for "%s"' % (question, ))
+        def fallback(result):
+            if result:
                 count = 0
                 self.msg(channel, 'Not entirely sure, maybe this helps?:')
                 for k, v in result.items():
                     if count < 2 and v is not None:
-                        self.msg(channel, v.encode('utf-8'))
+                        self.msg(channel, v.encode('utf-8'), bulk=True)
                     elif v is not None:
-                        self.msg(user, v.encode('utf-8'))
+                        self.msg(user, v.encode('utf-8'), bulk=True)
                     count += 1
+            else:
+                self.msg(channel, 'I don\'t know')
+        def reply(answer):
+            if answer:
+                self.msg(channel, answer.encode('utf-8'))
+            else:
+                # no direct answer: show whatever pods there are
+                self.cached(channel, fallback, 'wolfram_pods', w.search, question)
+        self.cached(channel, reply, 'wolfram', w.answer, question)
+
+
+    def historyOf(self, user, channel):
+        """
+        (network, channel) whose history a query asked on <channel> may
+        see, or None for private queries, which are turned down: the
+        history of a channel is only for those in it
+        """
+        if channel[:1] not in irc.CHANNEL_PREFIXES:
+            self.msg(user, 'Please ask in the channel whose history you want')
+            return None
+        return text(self.factory.network.name), text(channel)
+
+
+    @command('search', nargs=1, help='search <詞> - 搜尋聊天紀錄')
+    def search(self, user, channel, args):
+        where = self.historyOf(user, channel)
+        if where is None:
+            return
+        results = self.services.history.search(u' '.join(args), *where)
+        if not results:
+            self.msg(channel, 'Nothing found')
+        for ts, chan, nick, line in results:
+            self.msg(channel, (u'[%s] <%s> %s' % (
+                    time.strftime('%m-%d %H:%M', time.localtime(ts)),
+                    nick, line)).encode('utf-8'))
+
+
+    @command('seen', nargs=1, help='seen <nick> - 最後一次看到某人')
+    def seen(self, user, channel, args):
+        where = self.historyOf(user, channel)
+        if where is None:
+            return
+        seen = self.services.history.lastSeen(args[0], *where)
+        if seen is None:
+            self.msg(channel, '%s? Never seen.' % (args[0].encode('utf-8'), ))
+            return
+        ts, nick, chan = seen
+        self.msg(channel, (u'%s was last seen in %s at %s' % (nick, chan,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(ts)))).encode('utf-8'))
+
+
+    @command('last', nargs=1, help='last <nick> - 某人最後說的話')
+    def last(self, user, channel, args):
+        where = self.historyOf(user, channel)
+        if where is None:
+            return
+        last = self.services.history.last(args[0], *where)
+        if last is None:
+            self.msg(channel, '%s? Never seen.' % (args[0].encode('utf-8'), ))
+            return
+        ts, chan, nick, line = last
+        self.msg(channel, (u'[%s] <%s> %s' % (
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(ts)),
+                nick, line)).encode('utf-8'))
+
+
+    @command('cache', admin=True, help='cache - 快取與連線池統計')
+    def cachestats(self, user, channel, args):
+        s = self.services.cache.stats()
+        self.msg(user, 'cache: {entries} entries, {bytes} bytes, {hits} hits, '
+                '{misses} misses, {stale} stale, {evictions} evictions, '
+                '{fallbacks} served while down'.format(**s))
+        for host, pool in sorted(httpclient.stats().items()):
+            self.msg(user, 'http {0}: {1} reused, {2} new connections, {3} coalesced'.format(
+                    host, pool['hits'], pool['misses'], pool['coalesced']))
+
+
+    @command('log', admin=True, help='log - 紀錄檔寫入狀態')
+    def logstats(self, user, channel, args):
+        for path, logger in sorted(self.services.loggers.items()):
+            self.msg(user, 'log {0}: {1} lines queued, {2} written, {3} rotations, {4} errors'.format(
+                    path, logger.queueDepth(), logger.written, logger.rotations, logger.errors))
+
+
+    @command('stats', admin=True, help='stats - 各處理器次數、錯誤與延遲')
+    def stats(self, user, channel, args):
+        lines = ['lines: {0} handled, {1} chatter; outbound queue {2}'.format(
+                LINES.get('handled'), LINES.get('chatter'), self.outbound.depth())]
+        for title, seconds, errors in (('handler', HANDLER_SECONDS, HANDLER_ERRORS),
+                                       ('backend', BACKEND_SECONDS, BACKEND_ERRORS)):
+            busiest = sorted(seconds.values.keys(), key=lambda k: -seconds.count(*k))
+            for labels in busiest[:10]:
+                lines.append(u'{0} {1}: {2} calls, {3} errors, p50 {4:.1f}ms p99 {5:.1f}ms'.format(
+                        title, labels[0], seconds.count(*labels), errors.get(*labels),
+                        seconds.quantile(0.5, *labels) * 1000,
+                        seconds.quantile(0.99, *labels) * 1000).encode('utf-8'))
+        self.msg(user, '\n'.join(lines), bulk=True)
+        self.cachestats(user, channel, args)
+        self.logstats(user, channel, args)
+        self.queuestats(user, channel, args)
+        self.userstats(user, channel, args)
+        self.backendstats(user, channel, args)
+
+
+    @command('profile', admin=True, nargs=2, help='profile cpu|mem on|off - 剖析 CPU 或記憶體使用')
+    def profile(self, user, channel, args):
+        kind, action = args[0].lower(), args[1].lower()
+        if kind not in ('cpu', 'mem') or action not in ('on', 'off'):
+            self.msg(user, 'Usage: profile cpu|mem on|off')
+            return
+        # results go next to the log, e.g. log/profile-cpu-20131024-120000.txt
+        path = os.path.join(os.path.dirname(os.path.abspath(self.factory.network.logfile)),
+                            'profile-%s-%s.txt' % (kind, time.strftime('%Y%m%d-%H%M%S')))
+        top = option(self.services.config, 'profile', 'top', 10)
+        cpu = self.services.cpuProfiler
+        memory = self.services.memoryProfiler
+
+        def cpuReport(busiest):
+            self.msg(user, 'cpu: {0} samples in {1:.0f}s, saved to {2}'.format(
+                    cpu.samples, cpu.elapsed, path))
+            for name, own, total in busiest:
+                self.msg(user, '{0}: {1:.1f}% own, {2:.1f}% total'.format(
+                        name, own * 100.0 / cpu.samples, total * 100.0 / cpu.samples),
+                        bulk=True)
+
+        def memoryReport(growth):
+            self.msg(user, 'mem: saved to {0}'.format(path))
+            for name, count, added, size in growth:
+                self.msg(user, '{0}: {1} objects ({2:+d}), {3:+d} bytes'.format(
+                        name, count, added, size), bulk=True)
+
+        if kind == 'cpu' and action == 'on':
+            if cpu.start():
+                self.msg(user, 'cpu: sampling every {0}s'.format(cpu.interval))
+            else:
+                self.msg(user, 'cpu: already sampling')
+        elif kind == 'cpu':
+            if not cpu.stop():
+                self.msg(user, 'cpu: not sampling')
+            elif not cpu.samples:
+                self.msg(user, 'cpu: no samples')
+            else:
+                d = threads.deferToThread(cpu.save, path, top)
+                d.addCallback(cpuReport)
+                d.addErrback(self.logFailure, user)
+        elif action == 'on':
+            d = memory.start()
+            if d is None:
+                self.msg(user, 'mem: already on')
+            else:
+                d.addCallback(lambda types: self.msg(
+                        user, 'mem: baseline of {0} types taken'.format(types)))
+                d.addErrback(self.logFailure, user)
         else:
-            self.msg(channel, 'I don\'t know')
-        return True
+            d = memory.stop(path, top)
+            if d is None:
+                self.msg(user, 'mem: not on')
+            else:
+                d.addCallback(memoryReport)
+                d.addErrback(self.logFailure, user)
 
 
-    def unknown_command(self, cmd, user, channel, msg):
-        if cmd == 'help':
-            return False
+    @command('users', admin=True, help='users - 使用者表大小與記憶體')
+    def userstats(self, user, channel, args):
+        m = self.users.memory()
+        self.msg(user, 'users: {0} known, {1} free slots, {2} ranked, about {3} kB'.format(
+                m['users'], m['free'], len(self.services.leaderboard), m['bytes'] / 1024))
+
+
+    @command('backends', admin=True, help='backends - 後端斷路器狀態')
+    def backendstats(self, user, channel, args):
+        for b in self.services.backends:
+            self.msg(user, 'backend {0}: {1}, {2} failures in a row, p99 {3:.0f}ms, '
+                    '{4} retries, {5} refused'.format(b.name, b.state, b.failed,
+                    BACKEND_SECONDS.quantile(0.99, b.name) * 1000,
+                    RETRIES.get(b.name), REJECTED.get(b.name)), bulk=True)
+
+
+    @command('help')
+    def help(self, user, channel, args):
+        self.msg(user, self.commandsFor(channel).help, bulk=True, merge=True)
+
+
+    @command('queue', admin=True, help='queue - 送出訊息佇列狀態')
+    def queuestats(self, user, channel, args):
+        p50, p99, worst = self.outbound.latency()
+        self.msg(user, 'outbound: {0} queued, {1} sent, wait p50 {2:.2f}s '
+                'p99 {3:.2f}s max {4:.2f}s'.format(self.outbound.depth(),
+                self.outbound.sent, p50, p99, worst))
+
+
+    def unknown_command(self, cmd, user, channel):
         self.msg(channel, 'Affedersiniz.  "%s"\'den anlamadım.' % (cmd.encode('utf-8'),))
-        # self.wolfram(user, channel, msg)
-        return True
+        # self.wolfram(user, channel, [cmd])
 
 
     # callbacks for events
 
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
-        self.join(self.factory.channel)
+        self.services.startup.mark('sign on')
+        for settings in self.factory.network.channels.itervalues():
+            self.join(settings.name)
+        self.services.quotes.start()
+        def warmed(report):
+            if report:
+                self.logger.log('[warmed up: %s]' % (report, ))
+        d = self.services.warmUp(self.factory.network.enabledCommands())
+        d.addCallback(warmed)
+        d.addErrback(log.err)
 
 
     def joined(self, channel):
         """This will get called when the bot joins the channel."""
-        self.logger.log("[I have joined %s]" % channel)
+        self.loggerFor(channel).log("[I have joined %s]" % channel)
+        if self.services.startup.finish('join'):
+            print self.services.startup
+            self.logger.log('[%s]' % (self.services.startup, ))
 
 
     def privmsg(self, user, channel, msg):
         """This will get called when the bot receives a message."""
+        prefix = user
         user = user.split('!', 1)[0]
-        self.logger.log("<%s> %s" % (user, msg))
+        private = channel == self.nickname
+        if private:
+            self.logger.log("<%s> %s" % (user, msg))
+        else:
+            self.loggerFor(channel).chat(channel, user, msg, self.factory.network.name)
+        self.users.heard(user)
+        if self.services.mailbox.has(user):
+            self.deliver(user, user if private else channel)
+
+        # Most lines are chatter neither addressed to me nor matching any
+        # trigger; drop those before paying for decoding and splitting.
+        if not (private or msg.lstrip().startswith(self.nickname) or
+                self.services.triggers.mayMatch(msg)):
+            LINES.inc('chatter')
+            return
+        LINES.inc('handled')
+
         msg = msg.decode('UTF-8', 'ignore')
         parts = msg.split()
         
         # Check to see if they're sending me a private message
-        if channel == self.nickname:
+        if private:
             parts.insert(0, self.nickname+':')
             channel = user
             msg = self.nickname+': '+msg
@@ -416,69 +723,56 @@ class LogBot(irc.IRCClient):
         # MESSAGES NOT DIRECTED AT ME
         #=======================================
 
-        indirect_functions = [
-                self.award,
-                self.nobody_tw,
-                self.nobody_en,
-                ]
-        for f in indirect_functions:
+        for f in self.services.triggers.matching(msg):
+            start = time.time()
             try:
-                if f(user, channel, msg): return
+                if f(self, user, channel, msg): return
             except Exception as e:
+                HANDLER_ERRORS.inc(f.__name__)
                 self.logError(channel)
+            finally:
+                HANDLER_SECONDS.observe(time.time() - start, f.__name__)
 
 
         #===================================
         # MESSAGES DIRECTED AT ME
         #===================================
 
-        if parts[0] != self.nickname + ':':
+        if len(parts) < 2 or parts[0] != self.nickname + ':':
             return
         cmd = parts[1].lower()
+        args = parts[2:]
 
-        direct_functions = [
-                #self.cafe,
-                self.hi,
-                self.funslots,
-                self.quote,
-                #self.weather,
-                #self.tell,
-                #self.movie,
-                self.reddit,
-                self.moedict,
-                #self.define,
-                self.top10,
-                #self.song,
-                self.unknown_command,       # Keep this the last func
-                ]
-        for f in direct_functions:
-            try:
-                if f(cmd, user, channel, msg): return
-            except Exception as e:
-                self.logError(channel)
-                return
-
-        if cmd == 'help':
-            help_msg  = '請使用以下指令:\n'
-            for f in direct_functions:
-                if f.__doc__ is not None:
-                    help_msg += f.__doc__ + '\n'
-            help_msg += '或是隨便打，我不一定會去問 Wolfram'
-            self.msg(user, help_msg)
-
+        command = self.commandsFor(channel).get(cmd)
+        if command is None or (command.admin and not self.isAdmin(prefix)):
+            self.unknown_command(cmd, user, channel)
+            return
+        if len(args) < command.nargs:
+            self.msg(channel, 'Usage: %s' % (command.usage, ))
+            return
+        start = time.time()
+        try:
+            command.handler(self, user, channel, args)
+        except Exception as e:
+            HANDLER_ERRORS.inc(command.name)
+            self.logError(channel)
+        finally:
+            HANDLER_SECONDS.observe(time.time() - start, command.name)
 
 
 
     def userJoined(self, user, channel):
         """This will get called when I see a user join a channel"""
-        #check to see if I need to tell anyone anything
         self.remember(user, channel)
+        if self.services.mailbox.has(user):
+            self.deliver(user, channel)
 
 
     def action(self, user, channel, msg):
         """This will get called when the bot sees someone do an action."""
         user = user.split('!', 1)[0]
-        self.logger.log("* %s %s" % (user, msg))
+        self.loggerFor(channel).log("* %s %s" % (user, msg))
+        self.users.heard(user)
 
 
     # irc callbacks
@@ -500,28 +794,179 @@ class LogBot(irc.IRCClient):
 
 
 
-class LogBotFactory(protocol.ClientFactory):
-    """A factory for LogBots.
-
-    A new protocol instance will be created each time we connect to the server.
+class Services(object):
+    """
+    What every network shares: API keys, caches, persisted state and log
+    files.  One per process, however many networks the bot is on.
     """
 
-    def __init__(self, c):
-        self.channel  = c.get('irc', 'channel')
-        self.filename = c.get('irc', 'logfile')
-        self.nickname = c.get('irc', 'nickname')
+    def __init__(self, c, startup=None):
+        self.config = c
+        self.startup = startup or StartupReport()
         if c.has_section('wolfram'):
-            self.wolfram = c.get('wolfram', 'key')
+            from apis.wolfram import wolfram
+            self.wolfram = wolfram(c.get('wolfram', 'key'))
         else:
             self.wolfram = None
         if c.has_section('rottentomatoes'):
-            self.rottentomatoes = config.get('rottentomatoes', 'key')
+            self.rottentomatoes = c.get('rottentomatoes', 'key')
         else:
             self.rottentomatoes = None
+        self.owners = [o.strip() for o in option(c, 'admin', 'owners', '').split(',')
+                       if o.strip()]
+        self.backends = Backends(c)
+        self.cache = ResponseCache.fromConfig(c, self.backends.call)
+        self.quotes = QuotePool.fromConfig(c, self.fetchQuotes)
+        self.menu = DailyMenu.fromConfig(c, self.fetchMenu)
+        delay = option(c, 'persist', 'delay', 5.0)
+        max_dirty = option(c, 'persist', 'max_dirty', 100)
+        self.messages = JsonStore(MESSAGES_JSON, delay, max_dirty)
+        self.mailbox = Mailbox.fromConfig(c, self.messages)
+        self.users = UserTable.fromConfig(c, USERINFO_JSON)
+        self.users.load()
+        self.leaderboard = Leaderboard.fromUsers(self.users)
+        self.startup.mark('user info')
+        self.karma = KarmaJournal.fromConfig(c)
+        self.startup.mark('karma journal')
+        self.history = History.fromConfig(c)
+        self.startup.mark('history index')
+        self.triggers = TriggerSet(LogBot)
+        self.cpuProfiler = CpuProfiler.fromConfig(c)
+        self.memoryProfiler = MemoryProfiler()
+        self.loggers = {}       # path -> MessageLogger
+        self.warmed = set()
+        self.running = 0
+
+
+    def logger(self, path):
+        """ The MessageLogger writing <path>, shared by everyone logging there """
+        logger = self.loggers.get(path)
+        if logger is None:
+            logger = self.loggers[path] = MessageLogger.fromConfig(
+                    path, self.config, sink=self.history)
+        return logger
+
+
+    def warmUp(self, commands):
+        """
+        Import the modules of <commands> and connect to their backends in the
+        background; fires with a report of the time each took.
+        """
+        todo = [cmd.warm for cmd in commands
+                if cmd.warm is not None and cmd.warm not in self.warmed]
+        self.warmed.update(todo)
+        return threads.deferToThread(self._warm, todo)
+
+
+    def _warm(self, todo):
+        report = []
+        for module, url in todo:
+            start = time.time()
+            try:
+                __import__(module)
+                if url is not None:
+                    httpclient.warm(url)
+            except Exception as e:
+                # only a head start; the command will try again when used
+                print 'warming up %s failed: %s' % (module, e)
+            report.append('%s %.2fs' % (module, time.time() - start))
+        return ', '.join(report)
+
+
+    def start(self, network):
+        """
+        Called by every factory with its network; only the first call starts
+        anything but the menu prefetch, which waits for a network that has
+        `cafe` enabled somewhere
+        """
+        if 'cafe' in [cmd.name for cmd in network.enabledCommands()]:
+            self.menu.start()
+        self.running += 1
+        if self.running > 1:
+            return
+        self.shutdownTrigger = reactor.addSystemEventTrigger(
+                'after', 'shutdown', self.close)
+        self.karma.start()
+        self.mailbox.start()
+        self.users.start()
+
+
+    def stop(self):
+        self.running -= 1
+        if self.running > 0:
+            return
+        reactor.removeSystemEventTrigger(self.shutdownTrigger)
+        self.karma.stop()
+        self.menu.stop()
+        self.quotes.stop()
+        self.mailbox.stop()
+        self.users.stop()
+        self.cpuProfiler.stop()
+        self.close()
+
+
+    def flush(self):
+        """ Write out any pending changes to the persisted files now """
+        self.messages.flushNow()
+        self.users.store.flushNow()
+        self.karma.flush()
+        self.history.close()
+
+
+    def close(self):
+        """ Close the log files, then flush everything else """
+        for logger in self.loggers.itervalues():
+            logger.close()
+        self.loggers.clear()
+        self.flush()
+
+
+    def fetchQuotes(self, after):
+        """ A Deferred firing with a page of quotes from reddit """
+        return self.backends.call('reddit', self._getQuotes, after)
+
+
+    def _getQuotes(self, after):
+        from apis.reddit import getQuotes
+        return getQuotes(after)
+
+
+    def fetchMenu(self):
+        """ A Deferred firing with the menu scraped from the cafe's site """
+        return self.backends.call('cafe', self._scrapeMenu)
+
+
+    def _scrapeMenu(self):
+        from scrapers.cafescraper import scrapeCafe
+        return scrapeCafe()
+
+
+
+class LogBotFactory(protocol.ClientFactory):
+    """A factory for LogBots on one network.
+
+    A new protocol instance will be created each time we connect to the server.
+    """
+
+    def __init__(self, services, network):
+        self.services = services
+        self.network = network
+        self.nickname = network.nickname
+        self.retry = option(services.config, 'irc', 'retry', 60.0)
+
+
+    def startFactory(self):
+        self.services.start(self.network)
+
+
+    def stopFactory(self):
+        self.services.stop()
+
 
     def buildProtocol(self, addr):
-        p = LogBot(self.nickname)
+        p = LogBot(self.nickname, self.services.users)
         p.factory = self
+        p.services = self.services
         return p
 
 
@@ -531,24 +976,36 @@ class LogBotFactory(protocol.ClientFactory):
 
 
     def clientConnectionFailed(self, connector, reason):
-        print "connection failed:", reason
-        reactor.stop()
+        """ Try again later; the bot stays up on its other networks """
+        print "connection to %s failed:" % (self.network.name, ), reason
+        reactor.callLater(self.retry, connector.connect)
 
 
 if __name__ == '__main__':
     # initialize logging
     log.startLogging(sys.stdout)
+    startup.mark('imports')
     config = ConfigParser.RawConfigParser()
     config.read('config.cfg')
 
-    server = config.get('irc', 'server')
-    port   = int(config.get('irc', 'port'))
+    # API lookups run on the reactor thread pool; bound how many run at once
+    reactor.suggestThreadPoolSize(option(config, 'irc', 'threads', 10))
+    httpclient.configure(config)
+    # fork the parse workers, if any, before the reactor starts threads
+    procpool.configure(config)
+    reactor.addSystemEventTrigger('after', 'shutdown', procpool.shutdown)
     
-    # create factory protocol and application
-    f = LogBotFactory(config)
+    startup.mark('config')
+
+    if option(config, 'metrics', 'port', 0):
+        metrics.listen(option(config, 'metrics', 'port', 0),
+                       option(config, 'metrics', 'interface', '127.0.0.1'))
 
-    # connect factory to this host and port
-    reactor.connectTCP(server, port, f)
+    # one factory per network, all sharing the same services
+    services = Services(config, startup)
+    for network in networks(config, LogBot):
+        reactor.connectTCP(network.server, network.port,
+                           LogBotFactory(services, network))
 
     # run bot
     reactor.run()
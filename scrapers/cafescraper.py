@@ -2,12 +2,21 @@ def scrapeCafe():
 	"""
 	Scrape the EastBay Cafe's site for the current lunch menu
 	"""
-	from bs4 import BeautifulSoup
-	import requests
+	from apis import httpclient, procpool
 
-	# Get the page contents and make a soup object from it
-	page = requests.get('http://www.eastbaycafe.com/menu.php')
-	the_html = BeautifulSoup(page.text)
+	# Get the page contents and parse it, in the process pool if enabled
+	page = httpclient.get('http://www.eastbaycafe.com/menu.php')
+	return procpool.run(parseMenu, page.text)
+
+
+def parseMenu(html):
+	"""
+	The menu in the HTML of the cafe's menu page
+	"""
+	from bs4 import BeautifulSoup, SoupStrainer
+
+	# only build the tree for the menu, not the whole page
+	the_html = BeautifulSoup(html, parse_only=SoupStrainer('div', 'menu_content'))
 
 	mapping = {
 	    'Steam \'n Turren': 'steam',
@@ -0,0 +1,126 @@
+# -*- coding: utf8 -*-
+"""
+End-to-end tests of the real bot against tools/fakeircd.py, offline.
+"""
+import os
+import sys
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'tools'))
+from fakeircd import botFactory, FakeIRCd, Recorder
+
+
+CHANNEL = '#test_ircbot'
+# at most burst + rate * window lines with the default [outbound] rate=1
+# and burst=5, so a bot keeping to them is never dropped for flooding
+FLOOD_LINES = 9
+FLOOD_WINDOW = 3.0
+
+
+
+class FakeIRCdTests(unittest.TestCase):
+
+    timeout = 30
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        directory = os.path.abspath(self.mktemp())
+        os.makedirs(directory)
+        self.server = FakeIRCd(FLOOD_LINES, FLOOD_WINDOW)
+        self.port = reactor.listenTCP(0, self.server, interface='127.0.0.1')
+        _, self.factory = botFactory(self.port.getHost().port, CHANNEL, directory)
+        self.nick = self.factory.network.nickname
+        self.recorder = Recorder(self.server, self.nick)
+        self.replies = []
+        self.server.listeners.append(
+                lambda client, target, text: self.replies.append((target, text)))
+        self.joined = []
+        self.server.joins.append(self.botJoined)
+        self.connector = reactor.connectTCP('127.0.0.1', self.port.getHost().port,
+                                            self.factory)
+
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # stop reconnecting, then wait for the factory to stop its services
+        self.factory.clientConnectionLost = lambda connector, reason: None
+        stopped = defer.Deferred()
+        stopFactory = self.factory.stopFactory
+        def stop():
+            stopFactory()
+            stopped.callback(None)
+        self.factory.stopFactory = stop
+        self.connector.disconnect()
+        yield stopped
+        yield self.port.stopListening()
+        os.chdir(self.cwd)
+
+
+    def botJoined(self, client, channel):
+        if client.nick == self.nick:
+            waiting, self.joined = self.joined, []
+            for d in waiting:
+                d.callback(channel)
+
+
+    def nextJoin(self):
+        d = defer.Deferred()
+        self.joined.append(d)
+        return d
+
+
+    def sleep(self, seconds):
+        return task.deferLater(reactor, seconds, lambda: None)
+
+
+    @defer.inlineCallbacks
+    def waitFor(self, check, timeout=5.0):
+        """ Poll until check() is true, failing after <timeout> seconds """
+        for i in xrange(int(timeout / 0.05)):
+            if check():
+                return
+            yield self.sleep(0.05)
+        self.fail('timed out waiting for %r' % (check, ))
+
+
+    @defer.inlineCallbacks
+    def test_joinsAndAnswers(self):
+        """ The bot signs on, joins its channel and answers `hi` there """
+        channel = yield self.nextJoin()
+        self.assertEqual(channel, CHANNEL)
+        self.server.say('bob', CHANNEL, '%s: hi' % (self.nick, ))
+        yield self.waitFor(lambda: (CHANNEL, 'Hi! 我是 ' + self.nick) in self.replies)
+
+
+    @defer.inlineCallbacks
+    def test_reconnects(self):
+        """ Dropped by the server, the bot connects and joins again """
+        yield self.nextJoin()
+        rejoined = self.nextJoin()
+        self.recorder.drop(self.server)
+        channel = yield rejoined
+        self.assertEqual(channel, CHANNEL)
+        self.assertEqual(self.server.connects, 2)
+        self.assertEqual(len(self.recorder.reconnects), 1)
+        self.server.say('bob', CHANNEL, '%s: hi' % (self.nick, ))
+        yield self.waitFor(lambda: (CHANNEL, 'Hi! 我是 ' + self.nick) in self.replies)
+
+
+    @defer.inlineCallbacks
+    def test_floodControl(self):
+        """
+        Asked for far more replies than the server lets through at once,
+        the bot spreads them out under the flood limit instead of being
+        disconnected
+        """
+        yield self.nextJoin()
+        for i in xrange(3 * FLOOD_LINES):
+            self.server.say('user%d' % (i, ), CHANNEL, '%s: hi' % (self.nick, ))
+        yield self.sleep(FLOOD_WINDOW + 1.5)
+        self.assertEqual(self.server.flood_kills, 0)
+        self.assertEqual(self.server.connects, 1)
+        self.assertTrue(len(self.recorder.sent) >= FLOOD_LINES)
+        self.assertTrue(self.recorder.peak(FLOOD_WINDOW) <= FLOOD_LINES)
@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+"""
+Tests for core.history.
+"""
+import os
+import time
+
+from twisted.trial import unittest
+
+from core.history import History
+
+
+def noon(daysAgo):
+    """ Local noon <daysAgo> days back """
+    day = time.localtime(time.time() - daysAgo * 86400)
+    return int(time.mktime((day.tm_year, day.tm_mon, day.tm_mday, 12, 0, 0, 0, 0, -1)))
+
+
+
+class HistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.history = History(self.mktemp())
+        self.addCleanup(self.history.close)
+
+
+    def test_interleavedDays(self):
+        """
+        Lines of two days handed in turn, as the writer threads of two logs
+        do around midnight, go to their own day's segment.
+        """
+        yesterday, today = noon(1), noon(0)
+        self.history.add(yesterday, u'net', u'#a', u'bob', u'one apple')
+        self.history.add(today, u'net', u'#a', u'bob', u'two apples')
+        self.history.add(yesterday + 1, u'net', u'#a', u'eve', u'three apple')
+        self.history.add(today + 1, u'net', u'#a', u'bob', u'four apple')
+        self.assertEqual(
+            [entry[3] for entry in self.history.search(u'apple', u'net', u'#a', limit=10)],
+            [u'four apple', u'three apple', u'one apple'])
+        self.assertEqual(self.history.last(u'bob', u'net', u'#a'), (today + 1, u'#a', u'bob', u'four apple'))
+        self.assertEqual(self.history.last(u'eve', u'net', u'#a'),
+                         (yesterday + 1, u'#a', u'eve', u'three apple'))
+
+
+    def test_reopen(self):
+        """ The indexes saved on close find the same lines after a restart """
+        yesterday, today = noon(1), noon(0)
+        self.history.add(yesterday, u'net', u'#a', u'bob', u'one apple')
+        self.history.add(today, u'net', u'#a', u'bob', u'two apple')
+        self.history.add(yesterday + 1, u'net', u'#a', u'eve', u'three apple')
+        self.history.close()
+        history = History(self.history.directory)
+        self.addCleanup(history.close)
+        self.assertEqual(
+            [entry[3] for entry in history.search(u'apple', u'net', u'#a', limit=10)],
+            [u'two apple', u'three apple', u'one apple'])
+        self.assertEqual(history.last(u'eve', u'net', u'#a'), (yesterday + 1, u'#a', u'eve', u'three apple'))
+
+
+    def test_perChannel(self):
+        """ Queries only see the lines of the channel and network asked on """
+        now = noon(0)
+        self.history.add(now, u'net', u'#a', u'bob', u'apple on a')
+        self.history.add(now, u'net', u'#b', u'bob', u'apple on b')
+        self.history.add(now, u'other', u'#a', u'bob', u'apple elsewhere')
+        self.assertEqual([entry[3] for entry in self.history.search(u'apple', u'net', u'#A')],
+                         [u'apple on a'])
+        self.assertEqual(self.history.last(u'bob', u'net', u'#b')[3], u'apple on b')
+        self.assertEqual(self.history.lastSeen(u'BOB', u'other', u'#a')[2], u'#a')
+        self.assertIdentical(self.history.last(u'bob', u'other', u'#b'), None)
+        self.assertEqual(self.history.search(u'apple', u'net', u'#c'), [])
+
+
+    def test_withoutNetwork(self):
+        """ Lines from before networks were recorded match on any network """
+        self.history.close()
+        with open(os.path.join(self.history.directory,
+                               time.strftime('%Y-%m-%d') + '.log'), 'wb') as f:
+            f.write('%d\t#a\tbob\told apple\n' % (noon(0), ))
+        history = History(self.history.directory)
+        self.addCleanup(history.close)
+        self.assertEqual([entry[3] for entry in history.search(u'apple', u'net', u'#a')],
+                         [u'old apple'])
+        self.assertEqual(history.last(u'bob', u'net', u'#a')[3], u'old apple')
@@ -0,0 +1,367 @@
+# -*- coding: utf8 -*-
+"""
+Replay benchmark for the message pipeline.
+
+Drives a real LogBot (fake transport, stubbed apis.* backends, blocking
+calls run inline) with a synthetic channel log or a recorded one, and
+reports lines per second plus per-handler p50/p99 latency and allocations
+(net container objects per line, from the gc counters).  Results can be
+saved as a baseline and later runs compared against it:
+
+    python tools/bench.py --lines 50000 --save bench.json
+    python tools/bench.py --lines 50000 --baseline bench.json
+
+Comparing exits with status 1 when throughput or the p50 of a handler seen
+at least --min-lines times got more than --tolerance worse.  With --repeat
+the best of several runs, each on a fresh bot, is reported, which keeps
+the noise out of the comparison.
+
+--users instead measures the user table (core.users) at a given size,
+against the dict of dicts it replaced:
+
+    python tools/bench.py --users 1000000
+"""
+import argparse
+import ConfigParser
+import gc
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from twisted.internet import defer, task, threads
+from twisted.test import proto_helpers
+
+
+NICK = 'AL'
+CHANNEL = '#bench'
+NICKS = ['alice', 'bob', 'carol', 'dave', 'erin', u'小明'.encode('utf-8'),
+         u'阿華'.encode('utf-8'), 'mallory', 'trent', 'victor']
+WORDS = ['the', 'bot', 'lunch', 'deploy', 'python', 'twisted', 'server', 'g0v',
+         'meeting', 'today', 'is', 'broken', 'again', 'thanks', 'lol']
+CJK = [u'今天', u'午餐', u'開會', u'伺服器', u'部署', u'謝謝', u'好像', u'壞掉',
+       u'萌典', u'資料', u'開源', u'大家']
+COMMANDS = ['moe 萌', 'quote', 'reddit python', 'top10', 'top10 week', 'rank',
+            'karma bob', 'around', 'search deploy', 'seen alice', 'last bob',
+            'hi', 'help', 'funslots', 'nosuchcommand']
+RECORDED = re.compile(r'^\[\d\d:\d\d:\d\d\] <([^>]+)> (.*)$')
+
+
+def synthetic(n, seed=1):
+    """ <n> (nick, message) pairs of typical mixed channel traffic """
+    rnd = random.Random(seed)
+    lines = []
+    for i in xrange(n):
+        nick = rnd.choice(NICKS)
+        kind = rnd.random()
+        if kind < 0.45:
+            msg = ' '.join(rnd.choice(WORDS) for _ in xrange(rnd.randint(3, 15)))
+        elif kind < 0.75:
+            msg = u''.join(rnd.choice(CJK) for _ in xrange(rnd.randint(2, 10))).encode('utf-8')
+        elif kind < 0.85:
+            msg = ' '.join('%s++' % rnd.choice(NICKS) for _ in xrange(rnd.randint(1, 3)))
+        elif kind < 0.97:
+            msg = '%s: %s' % (NICK, rnd.choice(COMMANDS))
+        else:
+            msg = rnd.choice(['nobody here?', u'有沒有人'.encode('utf-8'),
+                              u'沒有人要吃飯嗎'.encode('utf-8')])
+        lines.append((nick, msg))
+    return lines
+
+
+def recorded(path):
+    """ The (nick, message) pairs of an irc.log written by MessageLogger """
+    lines = []
+    with open(path) as f:
+        for line in f:
+            m = RECORDED.match(line.rstrip('\n'))
+            if m:
+                lines.append(m.groups())
+    return lines
+
+
+def stubApis(inline=True):
+    """
+    Deterministic local answers instead of network lookups; with <inline>,
+    "blocking" calls also run inline instead of on the thread pool.
+    """
+    import apis.httpclient
+    import apis.moedict
+    import apis.reddit
+    apis.httpclient.warm = lambda url: None
+    apis.moedict.quote = lambda word: u'%s: 萌典的解釋' % (word, )
+    apis.reddit.getSubReddit = lambda query, count: {
+            'title': u'A post about %s' % (query, ), 'url': u'http://example.com/'}
+    apis.reddit.getQuote = lambda: u'A quote'
+    apis.reddit.getQuotes = lambda after=None, limit=100: (
+            [u'Quote %d' % i for i in xrange(limit)], None)
+    if inline:
+        # so every reply happens inside privmsg
+        threads.deferToThread = lambda f, *args, **kwargs: defer.maybeDeferred(f, *args, **kwargs)
+
+
+def makeBot(directory):
+    """ A connected LogBot whose files all live in <directory> """
+    os.chdir(directory)
+    os.mkdir('files')
+    os.mkdir('log')
+    for name in ('messages.json', 'user_info.json'):
+        with open(os.path.join('files', name), 'w') as f:
+            f.write('{}')
+    import ircbot
+    from core.networks import networks
+    c = ConfigParser.RawConfigParser()
+    c.read(os.path.join(ROOT, 'config.cfg.example'))
+    c.set('irc', 'channel', CHANNEL)
+    c.set('irc', 'nickname', NICK)
+    c.set('irc', 'logfile', 'log/irc.log')
+    c.set('admin', 'owners', '')
+    c.set('outbound', 'rate', '1e9')
+    c.set('outbound', 'burst', '1000000')
+    services = ircbot.Services(c)
+    factory = ircbot.LogBotFactory(services, networks(c, ircbot.LogBot)[0])
+    bot = factory.buildProtocol(None)
+    transport = proto_helpers.StringTransport()
+    bot.makeConnection(transport)
+    return bot, transport
+
+
+def classify(bot, msg):
+    """ The name of the handler <msg> ends up in, for the per-handler report """
+    parts = msg.split()
+    if len(parts) >= 2 and parts[0] == NICK + ':':
+        cmd = bot.commandsFor(CHANNEL).get(parts[1].decode('utf-8', 'ignore'))
+        return cmd.name if cmd is not None else 'unknown command'
+    if bot.services.triggers.mayMatch(msg):
+        for f in bot.services.triggers.matching(msg.decode('utf-8', 'ignore')):
+            return f.__name__
+    return 'chatter'
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(bot, transport, lines, warmup=500):
+    """ Feed <lines> through privmsg; per-handler timings and allocations """
+    labels = [classify(bot, msg) for nick, msg in lines]
+    prefixes = ['%s!%s@bench' % (nick, nick) for nick, msg in lines]
+    for i in xrange(min(warmup, len(lines))):
+        bot.privmsg(prefixes[i], CHANNEL, lines[i][1])
+    transport.clear()
+
+    timings = {}
+    allocs = {}
+    gc.collect()
+    gc.disable()
+    try:
+        start = default_timer()
+        for i, (nick, msg) in enumerate(lines):
+            before = gc.get_count()[0]
+            t = default_timer()
+            bot.privmsg(prefixes[i], CHANNEL, msg)
+            t = default_timer() - t
+            label = labels[i]
+            timings.setdefault(label, []).append(t)
+            allocs.setdefault(label, []).append(gc.get_count()[0] - before)
+            if gc.get_count()[0] > 100000:
+                gc.collect()
+            if i % 1000 == 0:
+                transport.clear()
+        elapsed = default_timer() - start
+    finally:
+        gc.enable()
+
+    result = {
+        'lines': len(lines),
+        'seconds': elapsed,
+        'throughput': len(lines) / elapsed,
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'handlers': {},
+    }
+    for label, values in timings.iteritems():
+        values.sort()
+        result['handlers'][label] = {
+            'n': len(values),
+            'p50_us': percentile(values, 0.50) * 1e6,
+            'p99_us': percentile(values, 0.99) * 1e6,
+            'allocs': float(sum(allocs[label])) / len(values),
+        }
+    return result
+
+
+def best(results):
+    """ The best throughput and per-handler figures of several runs """
+    result = max(results, key=lambda r: r['throughput'])
+    for label, h in result['handlers'].iteritems():
+        for other in results:
+            o = other['handlers'].get(label)
+            if o is not None:
+                for k in ('p50_us', 'p99_us', 'allocs'):
+                    h[k] = min(h[k], o[k])
+    return result
+
+
+def report(result, baseline=None):
+    print '%d lines in %.2fs: %.0f lines/s, max RSS %d kB' % (
+            result['lines'], result['seconds'], result['throughput'],
+            result['maxrss_kb'])
+    if baseline is not None:
+        print 'baseline: %.0f lines/s (%+.1f%%)' % (baseline['throughput'],
+                change(baseline['throughput'], result['throughput']))
+    print '%-16s %8s %10s %10s %8s' % ('handler', 'lines', 'p50 us', 'p99 us', 'allocs')
+    for label, h in sorted(result['handlers'].items(), key=lambda i: -i[1]['n']):
+        line = '%-16s %8d %10.1f %10.1f %8.1f' % (label, h['n'], h['p50_us'],
+                                                  h['p99_us'], h['allocs'])
+        old = baseline and baseline['handlers'].get(label)
+        if old:
+            line += '   p50 %+.1f%%' % (change(old['p50_us'], h['p50_us']), )
+        print line
+
+
+def change(old, new):
+    return (new - old) * 100.0 / old if old else 0.0
+
+
+def regressions(result, baseline, tolerance, min_lines):
+    """ What got more than <tolerance> (a fraction) worse than <baseline> """
+    found = []
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append('throughput')
+    for label, h in result['handlers'].iteritems():
+        old = baseline['handlers'].get(label)
+        if h['n'] < min_lines or not old:
+            continue
+        if h['p50_us'] > old['p50_us'] * (1 + tolerance):
+            found.append(label)
+    return found
+
+
+def timed(f, items):
+    """ Microseconds per call of f(item) """
+    start = default_timer()
+    for item in items:
+        f(item)
+    return (default_timer() - start) * 1e6 / max(len(items), 1)
+
+
+def userTable(n, seed=1):
+    """ Time and memory of a UserTable of <n> nicks, and of the old table """
+    from core.users import UserTable
+    rnd = random.Random(seed)
+    nicks = ['%s%d' % (rnd.choice(NICKS), i) for i in xrange(n)]
+    sample = rnd.sample(nicks, min(n, 100000))
+    directory = tempfile.mkdtemp(prefix='bench')
+    try:
+        clock = task.Clock()
+        clock.advance(1e9)
+        path = os.path.join(directory, 'user_info.json')
+        table = UserTable(path, max_dirty=sys.maxint, idle_days=1, clock=clock)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result = {'users': n}
+        result['add_us'] = timed(table.see, nicks)
+        result['rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        result['bytes'] = table.memory()['bytes']
+        result['get_us'] = timed(table.get, sample)
+        result['award_us'] = timed(table.award, sample[:n / 10])
+
+        start = default_timer()
+        table.store.flushNow()
+        result['save_s'] = default_timer() - start
+        start = default_timer()
+        UserTable(path).load()
+        result['load_s'] = default_timer() - start
+
+        clock.advance(2 * 86400)
+        moved = []
+        start = default_timer()
+        for _ in table._sweep(moved):
+            pass
+        result['sweep_s'] = default_timer() - start
+        result['swept'] = len(moved)
+        del table
+
+        legacy = dict((nick.decode('utf-8'), {'points': 0}) for nick in nicks)
+        result['legacy_bytes'] = sys.getsizeof(legacy) + sum(
+                sys.getsizeof(k) + sys.getsizeof(v) for k, v in legacy.iteritems())
+    finally:
+        shutil.rmtree(directory)
+    return result
+
+
+def reportUsers(r):
+    print '%d users: %.1f MB (%.0f bytes/user, old table %.0f), max RSS +%d kB' % (
+            r['users'], r['bytes'] / 1048576.0, float(r['bytes']) / r['users'],
+            float(r['legacy_bytes']) / r['users'], r['rss_kb'])
+    print 'add %.2f us, get %.2f us, award %.2f us' % (r['add_us'], r['get_us'], r['award_us'])
+    print 'save %.2fs, load %.2fs, sweep of %d idle users %.2fs' % (
+            r['save_s'], r['load_s'], r['swept'], r['sweep_s'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=20000,
+                        help='synthetic lines to replay (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log', help='replay this irc.log instead')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed slowdown against the baseline (default %(default)s)')
+    parser.add_argument('--min-lines', type=int, default=1000,
+                        help='only compare handlers seen this often (default %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='report the best of this many runs (default %(default)s)')
+    parser.add_argument('--users', type=int,
+                        help='benchmark the user table with this many nicks instead')
+    args = parser.parse_args()
+
+    if args.users:
+        reportUsers(userTable(args.users, args.seed))
+        return
+
+    if args.log:
+        lines = recorded(os.path.abspath(args.log))
+    else:
+        lines = synthetic(args.lines, args.seed)
+    save = args.save and os.path.abspath(args.save)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    stubApis()
+    results = []
+    for i in xrange(args.repeat):
+        directory = tempfile.mkdtemp(prefix='bench')
+        try:
+            bot, transport = makeBot(directory)
+            results.append(run(bot, transport, lines))
+            bot.services.quotes.stop()
+            bot.services.close()
+        finally:
+            os.chdir(ROOT)
+            shutil.rmtree(directory)
+    result = best(results)
+
+    report(result, baseline)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if baseline is not None:
+        worse = regressions(result, baseline, args.tolerance, args.min_lines)
+        if worse:
+            print 'REGRESSION: %s' % (', '.join(worse), )
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
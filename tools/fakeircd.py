@@ -0,0 +1,421 @@
+# -*- coding: utf8 -*-
+"""
+A stand-in IRC server with simulated users, for running the real bot
+offline.
+
+FakeIRCd speaks just enough IRC for twisted's IRCClient: registration,
+PING, JOIN/PART, PRIVMSG and QUIT.  Simulated users are not connections but
+names the server speaks for: a LoadGenerator has hundreds of them join the
+channel, chat (ASCII and CJK), award ++ and address commands to the bot at
+a configurable rate, and probes the bot with `hi` to time replies.  The
+server can drop the bot every so often to time reconnects, and can enforce
+a flood limit the way real servers do ("Excess Flood").
+
+    python tools/fakeircd.py --bot --users 300 --rate 50 --duration 30
+
+runs the real LogBotFactory/LogBot stack (apis stubbed) against it and
+reports reconnect times, reply latency and what the bot's outbound flood
+control let through.  Without --bot it just serves, for a bot started by
+hand with server=127.0.0.1 in its config.cfg.
+"""
+import argparse
+import ConfigParser
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import deque
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from twisted.internet import protocol, reactor, task
+from twisted.words.protocols import irc
+
+from bench import percentile, stubApis, synthetic
+
+
+HOST = 'fake.irc'
+
+
+
+class Client(irc.IRC):
+    """ One real connection to the server, e.g. the bot """
+
+    nick = None
+    registered = False
+
+
+    def connectionMade(self):
+        irc.IRC.connectionMade(self)
+        self.sent = deque()     # times of recent PRIVMSGs, for flood control
+        self.factory.connected(self)
+
+
+    def connectionLost(self, reason):
+        self.factory.disconnected(self)
+
+
+    @property
+    def prefix(self):
+        return '%s!%s@%s' % (self.nick, self.nick, HOST)
+
+
+    def irc_NICK(self, prefix, params):
+        self.nick = params[0]
+
+
+    def irc_USER(self, prefix, params):
+        self.registered = True
+        self.sendLine(':%s 001 %s :Welcome to the fake IRC network' % (HOST, self.nick))
+        self.sendLine(':%s 376 %s :End of MOTD' % (HOST, self.nick))
+
+
+    def irc_PING(self, prefix, params):
+        self.sendLine(':%s PONG %s :%s' % (HOST, HOST, params[-1]))
+
+
+    def irc_JOIN(self, prefix, params):
+        for channel in params[0].split(','):
+            self.factory.join(self, channel)
+
+
+    def irc_PART(self, prefix, params):
+        for channel in params[0].split(','):
+            self.factory.part(self, channel)
+
+
+    def irc_PRIVMSG(self, prefix, params):
+        self.factory.privmsg(self, params[0], params[-1])
+
+
+    def irc_QUIT(self, prefix, params):
+        self.transport.loseConnection()
+
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+
+
+class FakeIRCd(protocol.ServerFactory):
+
+    protocol = Client
+
+    def __init__(self, flood_lines=0, flood_window=10.0, clock=reactor):
+        """
+        @param flood_lines: drop a client sending more PRIVMSGs than this
+                            within flood_window seconds; 0 for no limit
+        """
+        self.flood_lines = flood_lines
+        self.flood_window = flood_window
+        self.clock = clock
+        self.clients = set()
+        self.channels = {}      # lower-case name -> set of Clients
+        self.virtual = {}       # lower-case name -> set of simulated nicks
+        self.listeners = []     # f(client, target, text) for PRIVMSGs from clients
+        self.joins = []         # f(client, channel) when a client joins
+        self.connects = 0
+        self.flood_kills = 0
+
+
+    def connected(self, client):
+        self.clients.add(client)
+        self.connects += 1
+
+
+    def disconnected(self, client):
+        self.clients.discard(client)
+        for members in self.channels.itervalues():
+            members.discard(client)
+
+
+    def join(self, client, channel):
+        members = self.channels.setdefault(channel.lower(), set())
+        members.add(client)
+        line = ':%s JOIN :%s' % (client.prefix, channel)
+        for member in members:
+            member.sendLine(line)
+        names = [c.nick for c in members] + sorted(self.virtual.get(channel.lower(), ()))
+        for i in xrange(0, len(names), 50):
+            client.sendLine(':%s 353 %s = %s :%s' % (HOST, client.nick, channel,
+                                                      ' '.join(names[i:i + 50])))
+        client.sendLine(':%s 366 %s %s :End of /NAMES list.' % (HOST, client.nick, channel))
+        for f in self.joins:
+            f(client, channel)
+
+
+    def part(self, client, channel):
+        members = self.channels.get(channel.lower(), set())
+        for member in members:
+            member.sendLine(':%s PART %s' % (client.prefix, channel))
+        members.discard(client)
+
+
+    def privmsg(self, client, target, text):
+        if self.flood_lines:
+            now = self.clock.seconds()
+            client.sent.append(now)
+            while client.sent[0] <= now - self.flood_window:
+                client.sent.popleft()
+            if len(client.sent) > self.flood_lines:
+                self.flood_kills += 1
+                client.sendLine('ERROR :Closing Link: %s (Excess Flood)' % (client.nick, ))
+                client.transport.loseConnection()
+                return
+        for f in self.listeners:
+            f(client, target, text)
+        self._deliver(client.prefix, target, text, client)
+
+
+    def _deliver(self, prefix, target, text, sender=None):
+        line = ':%s PRIVMSG %s :%s' % (prefix, target, text)
+        if target[0] in '#&':
+            recipients = self.channels.get(target.lower(), ())
+        else:
+            recipients = [c for c in self.clients if c.nick == target]
+        for client in recipients:
+            if client is not sender:
+                client.sendLine(line)
+
+
+    def say(self, nick, target, text):
+        """ A simulated user says <text> to a channel or a nick """
+        self._deliver('%s!%s@virtual' % (nick, nick), target, text)
+
+
+    def virtualJoin(self, nick, channel):
+        self.virtual.setdefault(channel.lower(), set()).add(nick)
+        line = ':%s!%s@virtual JOIN :%s' % (nick, nick, channel)
+        for client in self.channels.get(channel.lower(), ()):
+            client.sendLine(line)
+
+
+    def drop(self, nick):
+        """ Cut the connection of client <nick>, as a netsplit would """
+        for client in list(self.clients):
+            if client.nick == nick:
+                client.transport.loseConnection()
+
+
+
+class LoadGenerator(object):
+
+    def __init__(self, server, channel, bot='AL', users=200, rate=20.0,
+                 probe_interval=1.0, seed=1, clock=reactor):
+        """
+        @param rate: lines per second said by the simulated users together
+        @param probe_interval: seconds between `hi` probes timing replies
+        """
+        self.server = server
+        self.channel = channel
+        self.bot = bot
+        self.users = ['user%03d' % i for i in xrange(users)]
+        self.rate = rate
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.messages = [msg for nick, msg in synthetic(5000, seed)]
+        self.due = 0.0
+        self.said = 0
+        self.probes = deque()   # times of unanswered probes
+        self.lost = 0           # probes whose replies died with a connection
+        self.latencies = []
+        self.loop = task.LoopingCall(self.tick)
+        self.probing = task.LoopingCall(self.probe)
+        server.listeners.append(self.heard)
+        server.joins.append(self.joined)
+
+
+    def start(self):
+        for nick in self.users:
+            self.server.virtualJoin(nick, self.channel)
+        self.loop.start(0.05, now=False)
+        self.probing.start(self.probe_interval, now=False)
+
+
+    def stop(self):
+        for loop in (self.loop, self.probing):
+            if loop.running:
+                loop.stop()
+
+
+    def tick(self):
+        self.due += self.rate * 0.05
+        while self.due >= 1:
+            self.due -= 1
+            msg = self.random.choice(self.messages)
+            if msg.startswith('AL:'):
+                msg = self.bot + msg[len('AL'):]
+            self.server.say(self.random.choice(self.users), self.channel, msg)
+            self.said += 1
+
+
+    def probe(self):
+        self.probes.append(self.clock.seconds())
+        self.server.say('prober', self.channel, '%s: hi' % (self.bot, ))
+
+
+    def heard(self, client, target, text):
+        if client.nick == self.bot and text.startswith('Hi! ') and self.probes:
+            self.latencies.append(self.clock.seconds() - self.probes.popleft())
+
+
+    def joined(self, client, channel):
+        if client.nick == self.bot:
+            # the bot forgets its queued replies when it loses the connection
+            self.lost += len(self.probes)
+            self.probes.clear()
+
+
+
+class Recorder(object):
+    """ What the bot sent, and how long it took to come back after drops """
+
+    def __init__(self, server, bot, clock=reactor):
+        self.bot = bot
+        self.clock = clock
+        self.sent = []          # times of the bot's PRIVMSGs
+        self.dropped = None
+        self.reconnects = []
+        server.listeners.append(self.heard)
+        server.joins.append(self.joined)
+
+
+    def heard(self, client, target, text):
+        if client.nick == self.bot:
+            self.sent.append(self.clock.seconds())
+
+
+    def joined(self, client, channel):
+        if client.nick == self.bot and self.dropped is not None:
+            self.reconnects.append(self.clock.seconds() - self.dropped)
+            self.dropped = None
+
+
+    def drop(self, server):
+        if self.dropped is None:
+            self.dropped = self.clock.seconds()
+            server.drop(self.bot)
+
+
+    def peak(self, window):
+        """ Most lines the bot sent within any <window> seconds """
+        best = 0
+        start = 0
+        for i, t in enumerate(self.sent):
+            while self.sent[start] <= t - window:
+                start += 1
+            best = max(best, i - start + 1)
+        return best
+
+
+
+def startBot(port, channel, args):
+    """ The real bot stack, in a temporary directory, connected to <port> """
+    directory, factory = botFactory(port, channel, tempfile.mkdtemp(prefix='fakeircd'),
+                                    args.outbound_rate, args.outbound_burst)
+    network = factory.network
+    reactor.connectTCP(network.server, network.port, factory)
+    return directory, network.nickname
+
+
+def botFactory(port, channel, directory, outbound_rate=None, outbound_burst=None):
+    """
+    A LogBotFactory for the real bot, set up to connect to <port> and keep
+    its files in <directory>, which becomes the working directory
+    """
+    import ircbot
+    from core.networks import networks
+    os.chdir(directory)
+    os.mkdir('files')
+    os.mkdir('log')
+    for name in ('messages.json', 'user_info.json'):
+        with open(os.path.join('files', name), 'w') as f:
+            f.write('{}')
+    stubApis(inline=False)
+    c = ConfigParser.RawConfigParser()
+    c.read(os.path.join(ROOT, 'config.cfg.example'))
+    c.set('irc', 'server', '127.0.0.1')
+    c.set('irc', 'port', str(port))
+    c.set('irc', 'channel', channel)
+    c.set('irc', 'logfile', 'log/irc.log')
+    if outbound_rate is not None:
+        c.set('outbound', 'rate', str(outbound_rate))
+    if outbound_burst is not None:
+        c.set('outbound', 'burst', str(outbound_burst))
+    services = ircbot.Services(c)
+    network = networks(c, ircbot.LogBot)[0]
+    return directory, ircbot.LogBotFactory(services, network)
+
+
+def report(server, load, recorder, duration, burst_window):
+    latencies = sorted(load.latencies)
+    print 'simulated users said %d lines (%.1f/s)' % (load.said, load.said / duration)
+    print 'bot connected %d time(s); reconnects: %s' % (server.connects, ', '.join(
+            '%.2fs' % t for t in recorder.reconnects) or 'none')
+    if latencies:
+        print 'reply latency over %d probes: p50 %.3fs p99 %.3fs max %.3fs' % (
+                len(latencies), percentile(latencies, 0.5),
+                percentile(latencies, 0.99), latencies[-1])
+    print '%d probes unanswered, %d lost with a dropped connection' % (
+            len(load.probes), load.lost)
+    print 'bot sent %d lines (%.1f/s); at most %d in 1s, %d in %gs' % (
+            len(recorder.sent), len(recorder.sent) / duration, recorder.peak(1.0),
+            recorder.peak(burst_window), burst_window)
+    print 'flood kills: %d' % (server.flood_kills, )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=6667,
+                        help='0 picks a free port (default %(default)s)')
+    parser.add_argument('--channel', default='#test_ircbot')
+    parser.add_argument('--nick', default='AL', help="the bot's nick")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='lines per second from all users (default %(default)s)')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--drop-every', type=float, default=0,
+                        help='drop the bot every so many seconds to time reconnects')
+    parser.add_argument('--flood-lines', type=int, default=0,
+                        help='disconnect clients sending more lines than this ...')
+    parser.add_argument('--flood-window', type=float, default=10.0,
+                        help='... within this many seconds (default %(default)s)')
+    parser.add_argument('--bot', action='store_true',
+                        help='run the real bot in-process against the server')
+    parser.add_argument('--outbound-rate', type=float,
+                        help='override [outbound] rate for --bot')
+    parser.add_argument('--outbound-burst', type=int,
+                        help='override [outbound] burst for --bot')
+    args = parser.parse_args()
+
+    server = FakeIRCd(args.flood_lines, args.flood_window)
+    port = reactor.listenTCP(args.port, server, interface='127.0.0.1').getHost().port
+    print 'fake IRC server on 127.0.0.1:%d' % (port, )
+    directory = None
+    nick = args.nick
+    if args.bot:
+        directory, nick = startBot(port, args.channel, args)
+    load = LoadGenerator(server, args.channel, nick, args.users, args.rate)
+    recorder = Recorder(server, nick)
+
+    def begin(client, channel):
+        if client.nick == nick and not load.loop.running:
+            load.start()
+    server.joins.append(begin)
+    if args.drop_every:
+        task.LoopingCall(recorder.drop, server).start(args.drop_every, now=False)
+
+    reactor.callLater(args.duration, reactor.stop)
+    reactor.run()
+    load.stop()
+    report(server, load, recorder, args.duration, args.flood_window)
+    if directory is not None:
+        os.chdir(ROOT)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()